@@ -0,0 +1,206 @@
+"""
+Admission control
+=================
+
+Turns requests away early when the server is overloaded, instead of letting
+them queue behind busy request threads until they time out.
+
+Requests are divided into classes by endpoint:
+
+- Writes, like placing bids and logging in, may use at most the share of the
+  capacity that is not reserved, and their limit adapts to their latency.
+- Reads may use all of the capacity, so the reserved share is always there for
+  them.
+- Exempt endpoints, like the health check and event streams, are not limited.
+
+Rejected writes get a 429 response, and requests rejected for lack of any
+capacity a 503 response, both with a Retry-After header.
+"""
+
+import logging
+import threading
+from time import monotonic
+from typing import Optional
+
+from flask import Flask, Response, current_app, g, jsonify, request
+from flask_babel import _
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+"Methods that are never classified as writes."
+
+
+class ConcurrencyLimiter:
+    """
+    Limits the number of requests in flight.
+
+    With a `target_latency`, the limit adapts between `min_limit` and
+    `max_limit`: it shrinks when requests take longer than the target, and
+    grows back slowly while they are faster (additive increase, multiplicative
+    decrease).
+    """
+
+    def __init__(self, limit: int, min_limit: int = 1, target_latency: Optional[float] = None,
+                 backoff: float = 0.9):
+        self.max_limit = limit
+        self.min_limit = min(min_limit, limit)
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.limit = float(limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float = 0) -> bool:
+        """
+        Take a slot, waiting at most `timeout` seconds for one to free up.
+
+        :return: True if a slot was taken, and must be released.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: Optional[float] = None):
+        """
+        Give back a slot, adapting the limit to the latency of the request.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if self.target_latency is not None and latency is not None:
+                if latency > self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+
+class AdmissionController:
+    """
+    Admits requests by their endpoint class, see the module documentation.
+
+    :param capacity: Number of requests handled at the same time.
+    :param reserved_share: Share of the capacity reserved for reads.
+    :param target_latency: Seconds that writes should take, for adapting their limit.
+    :param queue_timeout: Seconds a request waits for a slot before being rejected.
+    """
+
+    def __init__(self, capacity: int, reserved_share: float = 0.25, target_latency: Optional[float] = None,
+                 queue_timeout: float = 0):
+        self.queue_timeout = queue_timeout
+        self.total = ConcurrencyLimiter(capacity)
+        self.writes = ConcurrencyLimiter(max(1, int(capacity * (1 - reserved_share))),
+                                         target_latency=target_latency)
+
+    def admit(self, write: bool) -> Optional[int]:
+        """
+        Take the slots for a request.
+
+        :return: None if admitted, or the status code to reject it with.
+        """
+        if write and not self.writes.acquire(self.queue_timeout):
+            return 429
+
+        if not self.total.acquire(self.queue_timeout):
+            if write:
+                self.writes.release()
+            return 503
+
+        return None
+
+    def release(self, write: bool, latency: Optional[float] = None):
+        """
+        Give back the slots of an admitted request.
+        """
+        self.total.release()
+        if write:
+            self.writes.release(latency)
+
+
+def init_admission(app: Flask):
+    """
+    Set up admission control for the requests of the application.
+    """
+    app.config.setdefault('ADMISSION_CONTROL', not app.testing)
+    "Whether to limit the requests handled at the same time."
+
+    app.config.setdefault('ADMISSION_CAPACITY', 64)
+    "Number of requests handled at the same time; about the number of request threads."
+
+    app.config.setdefault('ADMISSION_RESERVED_SHARE', 0.25)
+    "Share of the capacity that writes can not take, kept for reads."
+
+    app.config.setdefault('ADMISSION_TARGET_LATENCY', 0.5)
+    "Seconds that writes should take. Their limit is lowered while they take longer."
+
+    app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 0.1)
+    "Seconds a request waits for a slot before being rejected."
+
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+    "Seconds that rejected clients are asked to wait before retrying."
+
+    app.config.setdefault('ADMISSION_WRITE_ENDPOINTS', {
+        'items.bid',
+        'api_items.api_item_place_bid',
+        'api_items.api_place_bids',
+        'auth.login',
+        'auth.register',
+    })
+    "Endpoints that are writes when not requested with a safe method."
+
+    app.config.setdefault('ADMISSION_EXEMPT_ENDPOINTS', {
+        'static',
+        'hello',
+        'server_info',
+        'metrics',
+        'api_items.api_item_events',
+    })
+    "Endpoints that are never rejected, like health checks and long-lived event streams."
+
+    if not app.config['ADMISSION_CONTROL']:
+        return
+
+    app.extensions['admission'] = AdmissionController(
+        capacity=app.config['ADMISSION_CAPACITY'],
+        reserved_share=app.config['ADMISSION_RESERVED_SHARE'],
+        target_latency=app.config['ADMISSION_TARGET_LATENCY'],
+        queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT'],
+    )
+    app.before_request(_admit_request)
+    app.teardown_request(_release_request)
+
+
+def _admit_request() -> Optional[Response]:
+    """
+    Admit the request, or return the response rejecting it.
+    """
+    if request.endpoint in current_app.config['ADMISSION_EXEMPT_ENDPOINTS']:
+        return None
+
+    write = (request.method not in SAFE_METHODS
+             and request.endpoint in current_app.config['ADMISSION_WRITE_ENDPOINTS'])
+
+    admission: AdmissionController = current_app.extensions['admission']
+    if (status := admission.admit(write)) is None:
+        g.admission = (write, monotonic())
+        return None
+
+    logger.warning("Rejected request to %s with %d, server is busy", request.endpoint, status)
+    if request.blueprint and request.blueprint.startswith('api'):
+        response = jsonify({'error': _("Server is busy, please try again shortly.")})
+    else:
+        response = Response(_("Server is busy, please try again shortly."), mimetype='text/plain')
+    response.status_code = status
+    response.headers['Retry-After'] = str(current_app.config['ADMISSION_RETRY_AFTER'])
+    return response
+
+
+def _release_request(exc):  # pylint: disable=unused-argument
+    """
+    Release the slots of an admitted request.
+    """
+    if (admitted := g.pop('admission', None)) is not None:
+        write, started = admitted
+        current_app.extensions['admission'].release(write, monotonic() - started)
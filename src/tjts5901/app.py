@@ -57,9 +57,25 @@ def create_app(config: Optional[Dict] = None) -> Flask:
     # Initialize the Flask-Babel extension.
     init_babel(flask_app)
 
+    # Record request and database metrics. Before connecting, to see the commands.
+    from .metrics import init_metrics  # pylint: disable=import-outside-toplevel
+    init_metrics(flask_app)
+
+    # Break down the time of requests in the Server-Timing header, if enabled.
+    from .timing import init_server_timing  # pylint: disable=import-outside-toplevel
+    init_server_timing(flask_app)
+
     # Initialize the database connection.
     init_db(flask_app)
 
+    # Turn requests away early when overloaded.
+    from .admission import init_admission  # pylint: disable=import-outside-toplevel
+    init_admission(flask_app)
+
+    # Initialize the event broadcaster.
+    from .events import init_events  # pylint: disable=import-outside-toplevel
+    init_events(flask_app)
+
     # Initialize the scheduler.
     from .scheduler import init_scheduler  # pylint: disable=import-outside-toplevel
     init_scheduler(flask_app)
@@ -82,6 +98,7 @@ def create_app(config: Optional[Dict] = None) -> Flask:
 
     from . import items
     flask_app.register_blueprint(items.bp)
+    flask_app.register_blueprint(items.api)
     flask_app.add_url_rule('/', endpoint='index')
 
     return flask_app
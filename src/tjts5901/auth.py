@@ -1,9 +1,15 @@
+import atexit
+from collections import OrderedDict
 from datetime import datetime
 import functools
 import logging
+import threading
+from time import monotonic
+from typing import Any, Optional
 
+from bson import ObjectId
 from flask import (
-    Blueprint, flash, redirect, render_template, request, session, url_for, abort
+    Blueprint, flash, redirect, render_template, request, session, url_for, abort, current_app, has_app_context
 )
 from flask_login import (
     LoginManager,
@@ -13,13 +19,15 @@ from flask_login import (
     current_user,
 )
 from flask_babel import _
-from werkzeug.security import check_password_hash, generate_password_hash
 from sentry_sdk import set_user
 
+from .db import get_document, get_identity_map, prefetch_references
 from .models import AccessToken, User, Item
+from .passwords import PasswordHasherBusy, get_password_hasher, init_passwords
 
-from mongoengine import DoesNotExist
+from mongoengine import DoesNotExist, signals
 from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 logger = logging.getLogger(__name__)
@@ -37,38 +45,200 @@ def init_auth(app):
     app.config['AUTH_HEADER_NAME'] = 'Authorization'
     login_manager.request_loader(load_user_from_request)
 
+    app.config.setdefault('TOKEN_CACHE_SIZE', 1024)
+    app.config.setdefault('TOKEN_CACHE_TTL', 60)
+    "Seconds a token is trusted without checking the database."
+
+    app.config.setdefault('TOKEN_LAST_USED_INTERVAL', 5)
+    "Seconds between writing the last use times of tokens."
+
+    token_cache = app.extensions['token_cache'] = TokenCache(
+        maxsize=app.config['TOKEN_CACHE_SIZE'],
+        ttl=app.config['TOKEN_CACHE_TTL'],
+        flush_interval=app.config['TOKEN_LAST_USED_INTERVAL'],
+    )
+    atexit.register(token_cache.flush)
+
+    signals.post_save.connect(_invalidate_cached_token, sender=AccessToken)
+    signals.post_delete.connect(_invalidate_cached_token, sender=AccessToken)
+
+    app.config.setdefault('USER_CACHE_SIZE', 1024)
+    app.config.setdefault('USER_CACHE_TTL', 10)
+    "Seconds a logged in user is trusted without loading it again."
+
+    app.extensions['user_cache'] = LRUCache(
+        maxsize=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL'],
+    )
+    signals.post_save.connect(_invalidate_cached_user, sender=User)
+    signals.post_delete.connect(_invalidate_cached_user, sender=User)
+
+    init_passwords(app)
+
     login_manager.init_app(app)
 
     logger.debug("Initialized authentication")
 
 
+class LRUCache:
+    """
+    Thread-safe LRU cache, with entries expiring after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key) -> Optional[Any]:
+        """
+        Return the cached value, or None if missing or expired.
+        """
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                return None
+            cached_at, value = entry
+            if monotonic() - cached_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used one if full.
+        """
+        with self._lock:
+            self._entries[key] = (monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove an entry from the cache.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class TokenCache(LRUCache):
+    """
+    Cache of access tokens, for authenticating API requests without a query.
+
+    Maps tokens to their token id, user id and expiry time. Changes to tokens
+    in this process are seen right away, through the :class:`AccessToken`
+    signals; changes in other processes within the ttl.
+
+    The last use times of tokens are collected, and written with one bulk
+    write every `flush_interval` seconds.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, flush_interval: float = 5):
+        super().__init__(maxsize, ttl)
+        self.flush_interval = flush_interval
+        self._last_used: dict = {}
+        self._timer: Optional[threading.Timer] = None
+
+    def touch(self, token_id: ObjectId):
+        """
+        Record the use of a token, to be written by the next flush.
+        """
+        with self._lock:
+            self._last_used[token_id] = datetime.utcnow()
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Write the recorded last use times of tokens.
+        """
+        with self._lock:
+            last_used, self._last_used = self._last_used, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not last_used:
+            return
+
+        try:
+            AccessToken._get_collection().bulk_write([  # pylint: disable=protected-access
+                UpdateOne({'_id': token_id}, {'$max': {'last_used_at': used_at}})
+                for token_id, used_at in last_used.items()
+            ], ordered=False)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error writing token last use times: %s", exc, exc_info=True)
+
+
+def _invalidate_cached_token(sender, document, **kwargs):  # pylint: disable=unused-argument
+    """
+    Drop a saved or deleted token from the token cache.
+    """
+    if has_app_context() and (token_cache := current_app.extensions.get('token_cache')):
+        token_cache.invalidate(document.token)
+
+
+def _invalidate_cached_user(sender, document, **kwargs):  # pylint: disable=unused-argument
+    """
+    Drop a saved or deleted user from the user cache.
+    """
+    invalidate_cached_users([document.pk])
+
+
+def invalidate_cached_users(user_ids):
+    """
+    Drop users from the user cache, after updating them without saving the documents.
+    """
+    if has_app_context() and (user_cache := current_app.extensions.get('user_cache')):
+        for user_id in user_ids:
+            user_cache.invalidate(str(user_id))
+
+
 def load_user_from_request(request):
     """
     Load a user from the request.
 
     This function is used by Flask-Login to load a user from the request.
+    Tokens are looked up through the :class:`TokenCache`.
     """
     api_key = request.headers.get("Authorization")
 
     if api_key:
         api_key = api_key.replace("Bearer ", "", 1)
-        try:
-            token = AccessToken.objects.get(token=api_key)
-            if token.expires and token.expires < datetime.utcnow():
-                logger.warning("Token expired: %s", api_key)
+        token_cache: TokenCache = current_app.extensions['token_cache']
+
+        if (token_info := token_cache.get(api_key)) is None:
+            token = AccessToken.objects(token=api_key).only('user', 'expires').no_dereference().first()
+            if token is None:
+                logger.error("Token not found: %s", api_key)
                 return None
-            # User is authenticated
 
-            token.last_used_at = datetime.utcnow()
-            token.save()
-            logger.debug("User authenticated via token: %r", token.user.email, extra={
-                "user": token.user.email,
-                "user_id": str(token.user.id),
-                "token": token.token,
-            })
-            return token.user
+            token_info = (token.id, token._data['user'].id, token.expires)  # pylint: disable=protected-access
+            token_cache.put(api_key, token_info)
+
+        token_id, user_id, expires = token_info
+        if expires and expires < datetime.utcnow():
+            logger.warning("Token expired: %s", api_key)
+            return None
+
+        try:
+            user = get_document(User, user_id)
         except DoesNotExist:
-            logger.error("Token not found: %s", api_key)
+            logger.error("User not found for token: %s", api_key)
+            return None
+
+        # User is authenticated
+        token_cache.touch(token_id)
+        logger.debug("User authenticated via token: %r", user.email, extra={
+            "user": user.email,
+            "user_id": str(user.id),
+            "token": api_key,
+        })
+        return user
 
     return None
 
@@ -76,9 +246,18 @@ def load_user_from_request(request):
 def load_logged_in_user(user_id):
     """
     Load a user from the database, given the user's id.
+
+    Users are cached for `USER_CACHE_TTL` seconds. Saving or deleting a user
+    drops it from the cache of this process.
     """
+    user_cache: LRUCache = current_app.extensions['user_cache']
     try:
-        user = User.objects.get(id=user_id)
+        if (son := user_cache.get(user_id)) is None:
+            user = get_document(User, user_id)
+            user_cache.put(user_id, user.to_mongo().to_dict())
+        else:
+            # Each request gets its own copy of the user.
+            user = get_identity_map().setdefault((User, son['_id']), User._from_son(dict(son)))  # pylint: disable=protected-access
         set_user({"id": str(user.id), "email": user.email})
         "Set sessions user to current user"
     except DoesNotExist:
@@ -100,7 +279,8 @@ def get_user_by_email(email: str) -> User:
         abort(404)
 
     if email == "me" and current_user.is_authenticated:
-        email = current_user.email
+        # Already loaded for the request
+        return current_user._get_current_object()
 
     try:
         user = User.objects.get_or_404(email=email)
@@ -111,6 +291,24 @@ def get_user_by_email(email: str) -> User:
     return user
 
 
+def upgrade_password_hash(user: User, password: str):
+    """
+    Rehash the password of a user, after the hash method or cost was changed.
+
+    Meant to be called after a successful login, while the password is known.
+    Skipped if password hashing is busy; the next login tries again.
+    """
+    try:
+        pwhash = get_password_hasher().hash(password)
+    except PasswordHasherBusy:
+        logger.debug("Password hashing is busy, not upgrading the hash of %s", user.id)
+        return
+
+    # Unless the password was changed in the meanwhile.
+    User.objects(id=user.id, password=user.password).update_one(set__password=pwhash)
+    invalidate_cached_users([user.id])
+
+
 @bp.route('/register', methods=('GET', 'POST'))
 def register():
     """
@@ -132,11 +330,15 @@ def register():
                 #Create a user with email and password, password will be hashed
                 user = User(
                     email=email,
-                    password=generate_password_hash(password)
+                    password=get_password_hasher().hash(password)
                 )
                 user.save()
                 flash("Registration Successful!")
                 
+            except PasswordHasherBusy:
+                logger.warning("Password hashing is busy, turning away registration of %r", email)
+                flash(_("The server is busy, please try again in a moment."))
+                return render_template('auth/register.html'), 503, {'Retry-After': '5'}
             #Throw Error if anykind of exception occurred
             except Exception as exc:
                 error = f"Error when creating user: {exc!s}"
@@ -166,10 +368,18 @@ def login():
             error = 'Incorrect email'
 
         #Check if the password is correct
-        if user is None:
-            error = 'Incorrect email'
-        elif not check_password_hash(user['password'], password):
-            error = 'Incorrect password.'
+        hasher = get_password_hasher()
+        try:
+            if user is None:
+                error = 'Incorrect email'
+            elif not hasher.check(user['password'], password):
+                error = 'Incorrect password.'
+            elif hasher.needs_rehash(user['password']):
+                upgrade_password_hash(user, password)
+        except PasswordHasherBusy:
+            logger.warning("Password hashing is busy, turning away login of %r", email)
+            flash(_("Too many logins right now, please try again in a moment."))
+            return render_template('auth/login.html'), 503, {'Retry-After': '5'}
 
         #No errors so we can proceed to the auction page
         if error is None:
@@ -219,8 +429,8 @@ def profile(email):
 
     user: User = get_user_by_email(email)
 
-    # List the items user has created
-    items = Item.objects(seller=user).all()
+    # List the items user has created. The seller is known already.
+    items = prefetch_references(Item.objects(seller=user).no_dereference(), 'seller', known=[user])
 
     return render_template('auth/profile.html', user=user, items=items)
 
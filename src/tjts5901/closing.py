@@ -0,0 +1,135 @@
+"""
+Closing engine
+==============
+
+Closes auctions on time, without a scheduler job for each item.
+
+Item deadlines are kept in a min-heap, served by one thread that sleeps until
+the earliest deadline. Scheduling and rescheduling cost O(log n). Rescheduled
+and cancelled items are skipped lazily when their stale entries come up.
+"""
+
+from datetime import datetime
+import heapq
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ClosingEngine:
+    """
+    Calls `callback` with the id of each item when its closing time has passed.
+
+    All the methods are idempotent: scheduling an item again replaces its
+    deadline, and cancelling an item that is not scheduled does nothing.
+    """
+
+    def __init__(self, callback: Callable[[Any], None]):
+        self._callback = callback
+        self._heap: List[Tuple[datetime, Any]] = []
+        self._deadlines: Dict[Any, datetime] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, item_id, closes_at: datetime):
+        """
+        Schedule the item to be closed at `closes_at`, replacing any earlier deadline.
+        """
+        with self._condition:
+            if self._deadlines.get(item_id) == closes_at:
+                return
+
+            self._deadlines[item_id] = closes_at
+            heapq.heappush(self._heap, (closes_at, item_id))
+            self._compact()
+
+            # Wake the thread up if this is the new earliest deadline.
+            if self._heap[0][1] == item_id:
+                self._condition.notify()
+
+    def load(self, deadlines: Iterable[Tuple[Any, datetime]]):
+        """
+        Schedule many items at once, eg. when rebuilding the queue from the database.
+        """
+        with self._condition:
+            for item_id, closes_at in deadlines:
+                if self._deadlines.get(item_id) != closes_at:
+                    self._deadlines[item_id] = closes_at
+                    self._heap.append((closes_at, item_id))
+            heapq.heapify(self._heap)
+            self._compact()
+            self._condition.notify()
+
+    def cancel(self, item_id):
+        """
+        Stop tracking the item, eg. when it is closed or deleted.
+        """
+        with self._condition:
+            self._deadlines.pop(item_id, None)
+
+    def _compact(self):
+        # Drop stale entries once they outnumber the live ones.
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(closes_at, item_id) for item_id, closes_at in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def pop_due(self, now: Optional[datetime] = None) -> List[Any]:
+        """
+        Remove and return the ids of the items whose deadline is at or before `now`.
+        """
+        now = now or datetime.utcnow()
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                closes_at, item_id = heapq.heappop(self._heap)
+                if self._deadlines.get(item_id) == closes_at:
+                    del self._deadlines[item_id]
+                    due.append(item_id)
+        return due
+
+    def start(self):
+        """
+        Start the thread closing items.
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="closing-engine", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread, and wait for it to finish.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not (due := self.pop_due()):
+                    timeout = None
+                    if self._heap:
+                        timeout = max((self._heap[0][0] - datetime.utcnow()).total_seconds(), 0)
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+
+            for item_id in due:
+                try:
+                    self._callback(item_id)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Error closing item %s: %s", item_id, exc, exc_info=True, extra={
+                        'item_id': item_id,
+                    })
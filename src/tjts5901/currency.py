@@ -11,40 +11,60 @@ To update the currency conversion rates, run the following command:
 """
 
 from decimal import Decimal
+import functools
 import logging
+import os
 from pathlib import Path
+import threading
+from time import monotonic
+from typing import Dict, Iterable, Optional, Tuple, Union
 from zipfile import ZipFile
 import urllib.request
 import click
 from currency_converter import (
     SINGLE_DAY_ECB_URL,
     CurrencyConverter,
+    RateNotFoundError,
 )
+import numpy as np
 
 from flask_babel import (
     get_locale,
     format_currency,
 )
 
-from babel.numbers import get_territory_currencies, parse_decimal
+from babel import Locale
+from babel.numbers import (
+    get_currency_name,
+    get_currency_unit_pattern,
+    get_territory_currencies,
+    parse_decimal,
+)
 
 from flask import (
     Flask,
     current_app,
-    render_template,
 )
 
-from markupsafe import Markup
+from markupsafe import Markup, escape
 
 from .auth import current_user
+from .metrics import counter
+from .rates import RateTable, compile_rate_snapshot, is_snapshot_current
+from .timing import measured
 
 
 REF_CURRENCY = 'EUR'
 "Reference currency for the currency converter."
 
+MONEY_TAG = '<span title="%s">%s</span>'
+"Markup for a localized amount, with the amount in the reference currency as a tooltip."
+
 
 logger = logging.getLogger(__name__)
 
+CURRENCY_RELOADS = counter("currency_reloads_total", "Currency converter loads, by result.", ("result",))
+
 
 class CurrencyProxy:
     """
@@ -53,43 +73,161 @@ class CurrencyProxy:
     This class is used to proxy the currency converter instance. This is to
     ensure that the currency converter is only initialized when it is actually
     used, and the used conversion list is the most up-to-date.
+
+    The currency file is checked for changes at most every
+    `CURRENCY_RELOAD_INTERVAL` seconds, or on the next use after
+    :meth:`request_reload`. Updated files are parsed in a background thread, and
+    the new converter replaces the old one once it's ready.
     """
 
     def __init__(self, app: Flask):
         self._converter = None
         self._app = app
         self._converter_updated = 0
-        self._dataset_updated = 0
+        self._checked_at = 0.0
+        self._reload_requested = False
+        self._reloading = False
+        self._lock = threading.Lock()
+        self._rate_table = None
 
-    def get_currency_converter(self) -> CurrencyConverter:
+    def _load_currency_converter(self):
         """
-        Get a currency converter instance.
-
-        Automatically updates the currency converter if the dataset has been
-        updated.
+        Parse the currency file, and replace the current converter.
 
         Exceptions:
             RuntimeError: If the currency file is not configured.
             FileNotFoundError: If the currency file does not exist.
-
-        :return: A currency converter instance.
         """
 
         if not (conversion_file := self._app.config.get('CURRENCY_FILE')):
             raise RuntimeError('Currency file not configured.')
 
-        # Initialize the currency converter if it has not been initialized yet,
-        # or if the dataset has been updated.
-        self._dataset_updated = Path(conversion_file).stat().st_mtime
-        if self._converter is None or self._dataset_updated > self._converter_updated:
+        dataset_updated = Path(conversion_file).stat().st_mtime
+
+        if snapshot_file := self._app.config.get('CURRENCY_SNAPSHOT_FILE'):
+            if not is_snapshot_current(conversion_file, snapshot_file):
+                compile_rate_snapshot(conversion_file, snapshot_file, REF_CURRENCY)
+
+            logger.info("Initializing currency converter with snapshot %s.", snapshot_file)
+            converter = RateTable.load(snapshot_file, REF_CURRENCY)
+
+        else:
             logger.info("Initializing currency converter with file %s.", conversion_file)
-            self._converter = CurrencyConverter(
+            converter = CurrencyConverter(
                 currency_file=conversion_file,
                 ref_currency=REF_CURRENCY,
             )
-            self._converter_updated = self._dataset_updated
 
-        return self._converter
+        # Replacing the reference is atomic, readers get either the old or the new converter.
+        self._converter = converter
+        self._converter_updated = dataset_updated
+        CURRENCY_RELOADS.inc(result="ok")
+
+    def _reload_currency_converter(self):
+        """
+        Load the currency converter in a background thread.
+        """
+        try:
+            self._load_currency_converter()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Error reloading currency converter: %s", exc, exc_info=True)
+            CURRENCY_RELOADS.inc(result="error")
+        finally:
+            self._reloading = False
+
+    def _check_for_update(self):
+        """
+        Start reloading the currency converter if the currency file has changed.
+
+        Only one thread checks at a time, the others continue with the current
+        converter.
+        """
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            if self._reloading:
+                return
+
+            self._checked_at = monotonic()
+            self._reload_requested = False
+
+            try:
+                dataset_updated = Path(self._app.config['CURRENCY_FILE']).stat().st_mtime
+            except OSError as exc:
+                logger.warning("Error checking currency file: %s", exc)
+                return
+
+            if dataset_updated != self._converter_updated:
+                self._reloading = True
+                threading.Thread(target=self._reload_currency_converter,
+                       name="currency-reload", daemon=True).start()
+        finally:
+            self._lock.release()
+
+    def request_reload(self):
+        """
+        Check the currency file for changes on next use, regardless of the
+        reload interval.
+        """
+        self._reload_requested = True
+
+    def get_currency_converter(self) -> Union[CurrencyConverter, RateTable]:
+        """
+        Get a currency converter instance.
+
+        The first call loads the currency converter. Later calls return the
+        current converter, and start reloading it in the background if the
+        dataset has been updated.
+
+        Exceptions:
+            RuntimeError: If the currency file is not configured.
+            FileNotFoundError: If the currency file does not exist.
+
+        :return: A currency converter instance.
+        """
+
+        if (converter := self._converter) is None:
+            with self._lock:
+                if self._converter is None:
+                    self._load_currency_converter()
+                    self._checked_at = monotonic()
+                return self._converter
+
+        if self._reload_requested or \
+                monotonic() - self._checked_at >= self._app.config['CURRENCY_RELOAD_INTERVAL']:
+            self._check_for_update()
+
+        return converter
+
+    def get_rate_table(self) -> Tuple[Dict[str, int], np.ndarray]:
+        """
+        Get the most recent conversion rates as a vector.
+
+        Rates are relative to the `REF_CURRENCY`, and rebuilt whenever the
+        currency converter is. Currencies without a rate for the most recent
+        date have rate NaN.
+
+        :return: Mapping of currency codes to indices, and the vector of rates.
+        """
+
+        converter = self.get_currency_converter()
+        if isinstance(converter, RateTable):
+            return converter.get_rate_vector()
+
+        rate_table = self._rate_table
+        if rate_table is None or rate_table[0] is not converter:
+            index = {currency: i for i, currency in enumerate(sorted(converter.currencies))}
+            rates = np.full(len(index), np.nan)
+            for currency, i in index.items():
+                try:
+                    rates[i] = converter.convert(1, REF_CURRENCY, currency)
+                except RateNotFoundError:
+                    pass
+
+            rate_table = self._rate_table = (converter, index, rates)
+
+        return rate_table[1], rate_table[2]
 
     def __getattr__(self, name):
         """
@@ -111,16 +249,70 @@ def init_currency(app: Flask):
 
     # Set default currency file path
     app.config.setdefault('CURRENCY_FILE', app.instance_path + '/currency.csv')
+    # How often to check the currency file for changes, in seconds
+    app.config.setdefault('CURRENCY_RELOAD_INTERVAL', 60)
+    # Compiled snapshot of the currency file, shared by the worker processes. Set
+    # to a writable runtime path, eg. "/run/tjts5901/currency.npy", to enable.
+    # When None, each process parses the currency file instead.
+    app.config.setdefault('CURRENCY_SNAPSHOT_FILE', None)
 
     # Register the currency converter as an extension
     app.extensions['currency_converter'] = CurrencyProxy(app)
 
     # Register the currency converter as a template filter
     app.add_template_filter(format_converted_currency, name='localcurrency')
+    app.add_template_filter(format_converted_currencies, name='localcurrencies')
 
     app.cli.add_command(update_currency_rates)
 
 
+class MoneyFormatter:
+    """
+    Formats amounts of one currency in one locale.
+
+    Babel number patterns and currency names are looked up once, instead of on
+    every formatted amount. Output is the same as :func:`babel.numbers.format_currency`
+    with the default arguments.
+    """
+
+    def __init__(self, locale: Locale, currency: str):
+        self.locale = locale
+        self.currency = currency
+        self.pattern = locale.currency_formats['standard']
+        self.decimal_pattern = locale.decimal_formats[None]
+        self._long_names = {}
+
+    def format(self, value) -> str:
+        """
+        Format the value with the currency symbol, eg. "1 234,50 €".
+        """
+        return self.pattern.apply(value, self.locale, currency=self.currency)
+
+    def format_name(self, value) -> str:
+        """
+        Format the value with the currency name, eg. "1 234,50 euroa".
+        """
+        # Unit pattern and name depend on the plural form of the value.
+        plural_form = self.locale.plural_form(value)
+        if (long_name := self._long_names.get(plural_form)) is None:
+            long_name = self._long_names[plural_form] = (
+                get_currency_unit_pattern(self.currency, count=value, locale=self.locale),
+                get_currency_name(self.currency, count=value, locale=self.locale),
+            )
+
+        unit_pattern, display_name = long_name
+        number = self.decimal_pattern.apply(value, self.locale, currency=self.currency)
+        return unit_pattern.format(number, display_name)
+
+
+@functools.lru_cache(maxsize=256)
+def get_money_formatter(locale: str, currency: str) -> MoneyFormatter:
+    """
+    Get a (cached) money formatter for the locale and currency.
+    """
+    return MoneyFormatter(Locale.parse(locale), currency)
+
+
 def format_converted_currency(value, currency=None, **kwargs):
     """
     Render a currency value in the preferred currency.
@@ -130,17 +322,42 @@ def format_converted_currency(value, currency=None, **kwargs):
     the value is converted to the preferred currency.
     """
 
+    return format_converted_currencies([value], currency, **kwargs)[0]
+
+
+@measured('currency')
+def format_converted_currencies(values, currency=None, **kwargs) -> list[Markup]:
+    """
+    Render a list of currency values in the preferred currency.
+
+    Batch version of :func:`format_converted_currency`, for formatting a whole
+    column of amounts at once. Keyword arguments are passed to
+    :func:`flask_babel.format_currency`, which is slower than the default
+    formatting.
+    """
+
     if currency is None:
         currency = get_preferred_currency()
 
-    # Convert the value to the preferred currency
-    local_value = convert_currency(value, currency)
+    values = list(values)
+    local_values = values
+    if currency != REF_CURRENCY:
+        local_values = convert_many(values, currency).tolist()
+
+    if kwargs:
+        return [Markup(MONEY_TAG % (
+            escape(format_currency(value, currency=REF_CURRENCY, format_type='name', **kwargs)),
+            escape(format_currency(local_value, currency=currency, **kwargs)),
+        )) for value, local_value in zip(values, local_values)]
+
+    locale = str(get_locale())
+    base_formatter = get_money_formatter(locale, REF_CURRENCY)
+    local_formatter = get_money_formatter(locale, currency)
 
-    # Format the value
-    html = render_template("money-tag.html",
-                           base_amount=format_currency(value, currency=REF_CURRENCY, format_type='name', **kwargs),
-                           local_amount=format_currency(local_value, currency=currency, **kwargs))
-    return Markup(html)
+    return [Markup(MONEY_TAG % (
+        escape(base_formatter.format_name(value)),
+        escape(local_formatter.format(local_value)),
+    )) for value, local_value in zip(values, local_values)]
 
 
 def convert_currency(value, currency=None, from_currency=REF_CURRENCY):
@@ -158,6 +375,45 @@ def convert_currency(value, currency=None, from_currency=REF_CURRENCY):
     return value
 
 
+def convert_many(amounts: Iterable, to_currency: str, from_currency: str = REF_CURRENCY,
+                 decimals: Optional[int] = None) -> np.ndarray:
+    """
+    Convert many amounts from one currency to another at once.
+
+    Vectorized version of :func:`convert_currency`, using the most recent rates.
+    Gives the same results as converting the amounts one by one.
+
+    :param amounts: The amounts to convert.
+    :param to_currency: The currency to convert to.
+    :param from_currency: The currency to convert from.
+    :param decimals: If given, round the converted amounts to this many decimals.
+    :return: The converted amounts as floats.
+
+    Exceptions:
+        ValueError: If either currency is not supported.
+        RateNotFoundError: If either currency has no rate for the most recent
+            date, like :func:`convert_currency`.
+    """
+
+    amounts = np.asarray(amounts, dtype=np.float64)
+
+    if to_currency != from_currency:
+        index, rates = current_app.extensions['currency_converter'].get_rate_table()
+        for currency in (from_currency, to_currency):
+            if currency not in index:
+                raise ValueError(f"{currency} is not a supported currency")
+            if np.isnan(rates[index[currency]]):
+                raise RateNotFoundError(f"{currency} has no rate for the most recent date")
+
+        # Same order of operations as in `CurrencyConverter.convert()`.
+        amounts = amounts / rates[index[from_currency]] * rates[index[to_currency]]
+
+    if decimals is not None:
+        amounts = np.round(amounts, decimals)
+
+    return amounts
+
+
 def convert_from_currency(value, currency) -> Decimal:
     """
     Parses the localized currency value and converts it to the reference currency.
@@ -215,6 +471,8 @@ def update_currency_rates():
         with open(current_app.config['CURRENCY_FILE'], 'wb') as f:
             f.write(zf.read(file_name))
 
+    update_currency_snapshot()
+
     click.echo('Done.')
 
 def fetch_currency_file():
@@ -244,3 +502,18 @@ def fetch_currency_file():
 
             # Move the temporary file to the configured currency file path
             os.rename(f.name, current_app.config['CURRENCY_FILE'])
+
+    update_currency_snapshot()
+    current_app.extensions['currency_converter'].request_reload()
+
+
+def update_currency_snapshot():
+    """
+    Compile the currency file into the configured snapshot file, if any.
+
+    Worker processes memory-map the snapshot instead of parsing the currency
+    file themselves.
+    """
+
+    if snapshot_file := current_app.config.get('CURRENCY_SNAPSHOT_FILE'):
+        compile_rate_snapshot(current_app.config['CURRENCY_FILE'], snapshot_file, REF_CURRENCY)
@@ -1,20 +1,32 @@
+from collections import defaultdict
 import logging
 from os import environ
+from typing import Iterable, List, Type, TypeVar
+
+from bson import DBRef
+from flask import g, has_app_context
 from flask_mongoengine import MongoEngine
+from mongoengine import Document, ReferenceField
 
 db = MongoEngine()
 logger = logging.getLogger(__name__)
 
+DocumentT = TypeVar("DocumentT", bound=Document)
+
 def init_db(app):
     """
     Initialize the database connection.
 
     Fetches the database connection string from the environment variable `MONGO_URL`
     and, if present, sets the `MONGODB_SETTINGS` configuration variable to use it.
+    Settings given explicitly in the app config take precedence.
     """
 
     mongodb_url = environ.get('MONGO_URL')
-    if mongodb_url:
+    if 'MONGODB_SETTINGS' in app.config:
+        logger.debug("Using database settings from app config.")
+
+    elif mongodb_url:
         app.config['MONGODB_SETTINGS'] = {
             'host': mongodb_url,
         }
@@ -28,3 +40,116 @@ def init_db(app):
             extra={"MONGODB_SETTINGS": app.config.get("MONGODB_SETTINGS")} if app.debug else {})
 
     db.init_app(app)
+
+
+def prefetch_references(documents: Iterable[Document], *paths: str,
+                        known: Iterable[Document] = ()) -> List[Document]:
+    """
+    Resolve reference fields of the documents in batches.
+
+    Instead of dereferencing each reference when it is accessed, the referenced
+    ids are collected from all the documents and each referenced collection is
+    loaded with one query. Dotted paths resolve references of references::
+        >>> items = prefetch_references(Item.objects(seller=user), 'seller', 'winning_bid.bidder')
+
+    Works best on querysets with :meth:`no_dereference`, so that nothing is
+    resolved while iterating.
+
+    :param documents: The documents, or a queryset of them.
+    :param paths: Names of the reference fields to resolve.
+    :param known: Documents already loaded, such as the current user. These are
+        used without querying.
+    :return: The documents as a list.
+    """
+
+    documents = list(documents)
+    loaded = get_identity_map()
+    for doc in known:
+        loaded[(type(doc), doc.pk)] = doc
+
+    for path in paths:
+        targets = documents
+        for name in path.split("."):
+            targets = _resolve_references(targets, name, loaded)
+
+    return documents
+
+
+def _resolve_references(documents: List[Document], name: str, loaded: dict) -> List[Document]:
+    """
+    Replace the unresolved references in field `name` of the documents.
+
+    :return: The referenced documents.
+    """
+
+    # Group the missing ids by the referenced document class.
+    missing = defaultdict(set)
+    for doc in documents:
+        value = doc._data.get(name)  # pylint: disable=protected-access
+        if isinstance(value, DBRef):
+            document_type = doc._fields[name].document_type  # pylint: disable=protected-access
+            if (document_type, value.id) not in loaded:
+                missing[document_type].add(value.id)
+
+    for document_type, ids in missing.items():
+        for pk, doc in document_type.objects.in_bulk(list(ids)).items():
+            loaded[(document_type, pk)] = doc
+
+    targets = []
+    for doc in documents:
+        value = doc._data.get(name)  # pylint: disable=protected-access
+        if isinstance(value, DBRef):
+            document_type = doc._fields[name].document_type  # pylint: disable=protected-access
+            # Setting the data directly doesn't mark the field as changed.
+            value = doc._data[name] = loaded.get((document_type, value.id), value)  # pylint: disable=protected-access
+        if isinstance(value, Document):
+            targets.append(value)
+
+    return targets
+
+
+def get_identity_map() -> dict:
+    """
+    Return the identity map of the current request.
+
+    The identity map holds the documents loaded during the request, keyed by
+    their class and primary key, so that each document is loaded only once.
+    Outside of an application context an empty, throwaway map is returned.
+    """
+    if not has_app_context():
+        return {}
+
+    if "identity_map" not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def get_document(document_type: Type[DocumentT], pk) -> DocumentT:
+    """
+    Return a document by its primary key, through the identity map.
+
+    Raises :class:`~mongoengine.DoesNotExist` if there is no such document.
+
+    :param document_type: The document class.
+    :param pk: The primary key, as an :class:`ObjectId` or a string.
+    """
+    pk = document_type._fields[document_type._meta["id_field"]].to_python(pk)  # pylint: disable=protected-access
+    identity_map = get_identity_map()
+
+    if (document := identity_map.get((document_type, pk))) is None:
+        document = identity_map[(document_type, pk)] = document_type.objects.get(pk=pk)
+
+    return document
+
+
+class MappedReferenceField(ReferenceField):
+    """
+    Reference field that is dereferenced through the identity map.
+
+    Accessing the same referenced document from several documents during a
+    request results in a single query.
+    """
+
+    @staticmethod
+    def _lazy_load_ref(ref_cls, dbref):
+        return get_document(ref_cls, dbref.id)
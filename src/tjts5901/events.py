@@ -0,0 +1,187 @@
+"""
+Events
+======
+
+In-process publish/subscribe for pushing live updates to clients, such as new
+bids on an item.
+
+Events are published to named channels through the broadcaster registered in
+the application, and streamed to browsers as Server-Sent Events. The default
+:class:`LocalBroadcaster` only delivers events within the process. For several
+workers, configure a shared broadcaster in `EVENT_BROADCASTER`; any object
+implementing :class:`Broadcaster` will do.
+"""
+
+import json
+import logging
+import queue
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from flask import Flask, current_app
+
+logger = logging.getLogger(__name__)
+
+Event = Tuple[str, dict]
+"Event name, and its JSON serializable data."
+
+
+class Subscription:
+    """
+    Queue of events from one channel, for one subscriber.
+
+    If the subscriber falls behind, the oldest events are dropped, so a slow
+    client never blocks the publisher.
+    """
+
+    def __init__(self, channel: str, maxsize: int = 100):
+        self.channel = channel
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event: Event):
+        """
+        Add an event to the queue, dropping the oldest event if the queue is full.
+        """
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Event]:
+        """
+        Wait for the next event. Returns None if there was none within `timeout` seconds.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broadcaster:
+    """
+    Interface for delivering published events to the subscribers of a channel.
+    """
+
+    def subscribe(self, channel: str) -> Subscription:
+        """
+        Start receiving events published to the channel.
+        """
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Stop receiving events for the subscription.
+        """
+        raise NotImplementedError
+
+    def publish(self, channel: str, event: str, data: dict):
+        """
+        Deliver an event to all the current subscribers of the channel.
+        """
+        raise NotImplementedError
+
+
+class LocalBroadcaster(Broadcaster):
+    """
+    Broadcaster delivering events to subscribers in the same process.
+
+    Several applications can share an instance, which stands in for a shared
+    broadcaster when testing multiple workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channel: str, event: str, data: dict):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+
+        for subscription in subscriptions:
+            subscription.put((event, data))
+
+
+def init_events(app: Flask):
+    """
+    Initialize the event broadcaster.
+    """
+    app.config.setdefault('EVENT_STREAM_KEEPALIVE', 15)
+    "Seconds between keepalive messages on idle event streams."
+
+    app.extensions['broadcaster'] = app.config.get('EVENT_BROADCASTER') or LocalBroadcaster()
+
+
+def get_broadcaster() -> Broadcaster:
+    """
+    Return the broadcaster of the current application.
+    """
+    return current_app.extensions['broadcaster']
+
+
+def publish(channel: str, event: str, data: dict):
+    """
+    Publish an event through the broadcaster of the current application.
+
+    Errors are logged, and never fail the operation that published the event.
+    """
+    try:
+        get_broadcaster().publish(channel, event, data)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.warning("Error publishing event %s to %s: %s", event, channel, exc, exc_info=True)
+
+
+def format_sse(event: str, data: dict) -> str:
+    """
+    Format an event as a Server-Sent Events message.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(broadcaster: Broadcaster, subscription: Subscription, initial: Iterable[Event] = (),
+                  keepalive: float = 15, until: Iterable[str] = ()) -> Iterator[str]:
+    """
+    Generate Server-Sent Events messages for a subscription.
+
+    Sends a comment line every `keepalive` seconds while idle, so that proxies
+    don't close the connection. The subscription is cancelled when the
+    generator is closed, eg. when the client disconnects.
+
+    :param initial: Events to send first, such as the current state.
+    :param until: Names of the events after which the stream ends.
+    """
+    until = set(until)
+    try:
+        for event, data in initial:
+            yield format_sse(event, data)
+            if event in until:
+                return
+
+        while True:
+            if (message := subscription.get(timeout=keepalive)) is None:
+                yield ": keepalive\n\n"
+                continue
+
+            event, data = message
+            yield format_sse(event, data)
+            if event in until:
+                return
+    finally:
+        broadcaster.unsubscribe(subscription)
@@ -15,6 +15,8 @@ from flask import (
 
 import logging
 
+from .timing import measured
+
 logger = logging.getLogger(__name__)
 
 
@@ -79,6 +81,7 @@ def init_babel(flask_app: Flask):
     return babel
 
 
+@measured('locale')
 def get_locale():
     """
     Get the locale for user.
@@ -1,34 +1,72 @@
+import dataclasses
 from datetime import datetime, timedelta
+import json
 import logging
 from typing import Optional
+import click
 from flask import (
-    Blueprint, flash, redirect, render_template, request, url_for, jsonify, current_app
+    Blueprint, Response, flash, make_response, redirect, render_template, request, session, stream_with_context,
+    url_for, jsonify, current_app
 )
-from werkzeug.exceptions import abort
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import generate_etag
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+from mongoengine import NotUniqueError
+from mongoengine.queryset.visitor import Q
 
 from .auth import login_required, current_user
-from .models import Bid, Item
-from .notification import send_notification
+from .db import get_document, prefetch_references
+from .events import get_broadcaster, publish, stream_events
+from .models import Bid, Item, User
+from .notification import send_notifications
 
 bp = Blueprint('items', __name__)
 api = Blueprint('api_items', __name__, url_prefix='/api/items')
 
 logger = logging.getLogger(__name__)
 
-from flask_babel import _, lazy_gettext
+from flask_babel import _, get_locale, lazy_gettext
 from markupsafe import Markup
 
 MIN_BID_INCREMENT = 1
 
+ITEMS_PER_PAGE = 50
+"Number of items shown on one page of the item listing."
+
+ITEM_LISTING_FIELDS = ('title', 'description', 'starting_bid', 'seller', 'created_at', 'closes_at')
+"Fields loaded for the item listing."
+
+MAX_BATCH_BIDS = 100
+"Maximum number of bids in one batch request."
+
+BID_SAVE_RETRIES = 3
+"How many times saving a bid is attempted before giving up."
+
+BIDS_PER_PAGE = 100
+"Default number of bids in one page of the bid history API."
+
+MAX_BIDS_PER_PAGE = 1000
+"Maximum number of bids in one page of the bid history API."
+
+CLOSE_ITEMS_BATCH_SIZE = 1000
+"Number of items closed with one set of bulk queries."
+
+ITEM_ETAG_FIELDS = ('leading_bid', 'bid_count', 'closed', 'closes_at', 'updated_at')
+"Fields of the item that the ETags of item pages are derived from."
+
 def get_item(id):
     """
     Returns an item.
 
+    Repeated calls during a request return the same instance without querying.
+
     :param id: The ID of the item to be returned.
     :return: An item with the ID given as a parameter.
     """
     try:
-        item = Item.objects.get_or_404(id=id)
+        item = get_document(Item, id)
     except Exception as exc:
         print("Error getting item:", exc)
         abort(404)
@@ -44,40 +82,126 @@ def get_winning_bid(item: Item) -> Optional[Bid]:
 
     If there are no bids, return None.
 
+    Reads the denormalized :attr:`Item.leading_bid`, so no bid query is made.
+
     :param item: The item to get the winning bid for.
     :return: The winning bid, or None.
     """
 
-    winning_bid = None
-
     # Return winning bid, if the item is closed
     if item.closed and item.winning_bid:
         return item.winning_bid
 
-    # Sanity check: if the item is not closed, it should not have a winning bid
-    assert not item.closed or not (not item.closed and winning_bid), "Item is not closed, but has a winning bid"
+    return item.leading_bid
 
-    try:
-        winning_bid = Bid.objects(item=item) \
-            .filter(created_at__lt=item.closes_at) \
-            .order_by('-amount') \
-            .first()
-        # Print for debugging
-        # print("Bid.objects:")
-        # print(Bid.objects.first())
-    except Exception as exc:
-        logger.warning("Error getting winning bid: %s", exc, exc_info=True, extra={
-            'item_id': item.id,
-        })
 
-    return winning_bid
+def backfill_item_prices() -> int:
+    """
+    Populate the leading bid, current price and bid count of items bid on before
+    they were maintained on bid placement.
+
+    Until then such items accept bids below their highest bid, as their price
+    falls back to the starting bid. The leading bid is the highest bid placed
+    before the item's closing time, like in :func:`find_highest_bids`. Items are
+    handled :data:`CLOSE_ITEMS_BATCH_SIZE` at a time, each batch with one
+    aggregation and one bulk write. Items that got a leading bid meanwhile are
+    left alone.
+
+    :return: Number of items updated.
+    """
+
+    count = 0
+    last_id = None
+    while True:
+        items = Item.objects(leading_bid=None).only('closes_at').order_by('id').limit(CLOSE_ITEMS_BATCH_SIZE)
+        if last_id is not None:
+            items = items.filter(id__gt=last_id)
+        items = list(items.as_pymongo())
+        if not items:
+            return count
+        last_id = items[-1]['_id']
+
+        pipeline = [
+            {'$match': {'$or': [
+                {'item': item['_id'], 'created_at': {'$lte': item['closes_at']}} for item in items
+            ]}},
+            {'$sort': {'item': 1, 'amount': -1, 'created_at': 1}},
+            {'$group': {'_id': '$item', 'bid': {'$first': '$$ROOT'}, 'count': {'$sum': 1}}},
+        ]
+        results = list(Bid._get_collection().aggregate(pipeline))  # pylint: disable=protected-access
+        if not results:
+            continue
+
+        Item._get_collection().bulk_write([  # pylint: disable=protected-access
+            UpdateOne({'_id': result['_id'], 'leading_bid': None}, {'$set': {
+                'leading_bid': result['bid']['_id'],
+                'current_price': result['bid']['amount'],
+                'bid_count': result['count'],
+            }}) for result in results
+        ], ordered=False)
+        count += len(results)
+
+
+def get_closing_notifications(item: Item, winning_bid: Optional[Bid]) -> list[dict]:
+    """
+    Return the notifications sent to the seller and the buyer when the item closes.
+
+    :param item: The closing item.
+    :param winning_bid: The winning bid, or None if the item was not sold.
+    :return: Notifications for :func:`send_notifications`.
+    """
+
+    # lazy_gettext() is used to delay the translation until the message is sent
+    # Markup.escape() is used to escape strings, to prevent XSS attacks
+    if winning_bid:
+        return [
+            dict(
+                user=item.seller,
+                title=lazy_gettext("Your item was sold"),
+                message=lazy_gettext("Your item <em>%(title)s</em> was sold to %(buyer)s for %(price)s.",
+                                     title=Markup.escape(item.title),
+                                     buyer=Markup.escape(winning_bid.bidder.email),
+                                     price=Markup.escape(winning_bid.amount)),
+            ),
+            dict(
+                user=winning_bid.bidder,
+                title=lazy_gettext("You won an item"),
+                message=lazy_gettext("You won the item <em>%(title)s</em> for %(price)s.",
+                                     title=Markup.escape(item.title),
+                                     price=Markup.escape(winning_bid.amount)),
+            ),
+        ]
+
+    # If there is no winning bid, send a notification to the seller
+    return [
+        dict(
+            user=item.seller,
+            title=lazy_gettext("Your item was not sold"),
+            message=lazy_gettext("Your item <em>%(title)s</em> was not sold.",
+                                 title=Markup.escape(item.title)),
+        ),
+    ]
+
+
+def publish_closing(item: Item, winning_bid: Optional[Bid]):
+    """
+    Publish the closing of the item to the subscribers of its price stream.
+    """
+    publish(item_channel(item.id), 'closed', {
+        'item': str(item.id),
+        'winning_bid': serialize_bid(winning_bid) if winning_bid else None,
+    })
+
 
 def handle_item_closing(item):
     """
     Handle closing of an item.
 
     Checks if the item should be closed now and
-    sends notification to the seller and the buyer
+    sends notification to the seller and the buyer.
+    Closing is a conditional update, so an item is closed and notified about
+    only once, even if several processes try to close it. It also requires the
+    leading bid to be the one loaded, so a bid accepted in the meantime wins.
 
     :param item: Item to handle
     """
@@ -89,42 +213,191 @@ def handle_item_closing(item):
             'item_closes_at': item.closes_at,
         })
 
-        # Get the winning bid
-        winning_bid = get_winning_bid(item)
-        if winning_bid:
-            item.winning_bid = winning_bid
-
-            # Send a notifications to the seller and the buyer
-            # lazy_gettext() is used to delay the translation until the message is sent
-            # Markup.escape() is used to escape strings, to prevent XSS attacks
-            send_notification(
-                item.seller,
-                title=lazy_gettext("Your item was sold"),
-                message=lazy_gettext("Your item <em>%(title)s</em> was sold to %(buyer)s for %(price)s.",
-                                     title=Markup.escape(item.title),
-                                     buyer=Markup.escape(winning_bid.bidder.email),
-                                     price=Markup.escape(winning_bid.amount)),
-            )
-            send_notification(
-                winning_bid.bidder,
-                title=lazy_gettext("You won an item"),
-                message=lazy_gettext("You won the item <em>%(title)s</em> for %(price)s.",
-                                     title=Markup.escape(item.title),
-                                     price=Markup.escape(winning_bid.amount)),
-            )
-
-        else:
-            # If there is no winning bid, send a notification to the seller
-            send_notification(
-                item.seller,
-                title=lazy_gettext("Your item was not sold"),
-                message=lazy_gettext("Your item <em>%(title)s</em> was not sold.",
-                                     title=Markup.escape(item.title)),
-            )
+        while True:
+            leading_bid = item._data.get('leading_bid')  # pylint: disable=protected-access
+            leading_bid_id = leading_bid.id if leading_bid is not None else None
+
+            # Get the winning bid. Items bid on before leading bids were
+            # maintained have none.
+            winning_bid = get_winning_bid(item)
+            if winning_bid is None:
+                winning_bid = find_highest_bids([item]).get(item.id)
+
+            # Close the item, unless another process got to it first.
+            now = datetime.utcnow()
+            if Item.objects(id=item.id, closed__ne=True, leading_bid=leading_bid_id).update_one(
+                set__closed=True,
+                set__winning_bid=winning_bid,
+                set__updated_at=now,
+            ):
+                break
+
+            # Closed by another process, or outbid since the item was loaded.
+            try:
+                item.reload('closed', 'leading_bid')
+            except Item.DoesNotExist:
+                logger.debug("Item %s was deleted", item.id)
+                return
+            if item.closed:
+                logger.debug("Item %s was already closed", item.id)
+                return
 
-        # Close the item
         item.closed = True
-        item.save()
+        item.winning_bid = winning_bid
+        item.updated_at = now
+
+        # Send a notifications to the seller and the buyer
+        send_notifications(get_closing_notifications(item, winning_bid))
+
+        publish_closing(item, winning_bid)
+
+
+def find_highest_bids(items: list[Item]) -> dict[ObjectId, Bid]:
+    """
+    Find the highest bids of many items with one aggregation.
+
+    The highest bid is the highest bid placed before the item's closing time,
+    the earliest one on a tie. References of the bids are not resolved.
+
+    :param items: Items with `closes_at` loaded.
+    :return: Highest bids by item id. Items without bids are left out.
+    """
+
+    if not items:
+        return {}
+
+    pipeline = [
+        {'$match': {'$or': [
+            {'item': item.id, 'created_at': {'$lte': item.closes_at}} for item in items
+        ]}},
+        {'$sort': {'item': 1, 'amount': -1, 'created_at': 1}},
+        {'$group': {'_id': '$item', 'bid': {'$first': '$$ROOT'}}},
+    ]
+
+    return {
+        result['_id']: Bid._from_son(result['bid'])  # pylint: disable=protected-access
+        for result in Bid._get_collection().aggregate(pipeline)  # pylint: disable=protected-access
+    }
+
+
+def find_winning_bids(items: list[Item]) -> dict[ObjectId, Bid]:
+    """
+    Load the winning bids of many items with at most two queries.
+
+    The winner is the leading bid of the item. Bids are only accepted while the
+    item is open, and bids still being placed or rejected are never leading,
+    so there is no need to look at the other bids. Items without a leading bid
+    might have been bid on before leading bids were maintained, so their
+    highest bids are looked up with :func:`find_highest_bids`. References of
+    the bids are not resolved.
+
+    :param items: Items with `leading_bid` and `closes_at` loaded, without
+        references resolved.
+    :return: Winning bids by item id. Items without bids are left out.
+    """
+
+    leading_bids = {
+        item._data['leading_bid'].id: item.id  # pylint: disable=protected-access
+        for item in items if item._data.get('leading_bid') is not None  # pylint: disable=protected-access
+    }
+
+    winning_bids = {}
+    if leading_bids:
+        bids = Bid.objects.no_dereference().in_bulk(list(leading_bids))
+        winning_bids = {leading_bids[bid_id]: bid for bid_id, bid in bids.items()}
+
+    winning_bids.update(find_highest_bids([
+        item for item in items if item._data.get('leading_bid') is None  # pylint: disable=protected-access
+    ]))
+    return winning_bids
+
+
+def close_items(items: list[Item]) -> int:
+    """
+    Close many expired items at once.
+
+    Bulk version of :func:`handle_item_closing`, with a constant number of
+    database round trips: the winners are loaded with one or two queries, the
+    items are closed with one bulk write, and the notifications are sent as one
+    batch.
+
+    Items closed by another process in the meantime are skipped. So are items
+    whose leading bid changed since they were loaded, for
+    :func:`close_expired_items` to load them again. The bulk write tags the
+    items it closes with an id for this run, and only those are notified
+    about.
+
+    :param items: Expired items with `leading_bid` and `closes_at` loaded,
+        without references resolved.
+    :return: Number of items closed by this call.
+    """
+
+    if not items:
+        return 0
+
+    winning_bids = find_winning_bids(items)
+
+    closing_id = ObjectId()
+    now = datetime.utcnow()
+    Item._get_collection().bulk_write([  # pylint: disable=protected-access
+        UpdateOne({
+            '_id': item.id,
+            'closed': {'$ne': True},
+            'leading_bid': item._data['leading_bid'].id if item._data.get('leading_bid') else None,  # pylint: disable=protected-access
+        }, {'$set': {
+            'closed': True,
+            'winning_bid': winning_bids[item.id].id if item.id in winning_bids else None,
+            'updated_at': now,
+            'closing_id': closing_id,
+        }}) for item in items
+    ], ordered=False)
+
+    closed_ids = set(Item.objects(id__in=[item.id for item in items], closing_id=closing_id).distinct('id'))
+    items = [item for item in items if item.id in closed_ids]
+    if not items:
+        return 0
+
+    # Load the sellers and the buyers together.
+    winning_bids = {item.id: winning_bids[item.id] for item in items if item.id in winning_bids}
+    users = User.objects.in_bulk(list(
+        {item._data['seller'].id for item in items}  # pylint: disable=protected-access
+        | {bid._data['bidder'].id for bid in winning_bids.values()}  # pylint: disable=protected-access
+    )).values()
+    prefetch_references(items, 'seller', known=users)
+    prefetch_references(winning_bids.values(), 'bidder', known=users)
+
+    notifications = []
+    for item in items:
+        notifications.extend(get_closing_notifications(item, winning_bids.get(item.id)))
+    send_notifications(notifications)
+
+    for item in items:
+        publish_closing(item, winning_bids.get(item.id))
+
+    logger.info("Closed %d items, %d of them sold", len(items), len(winning_bids))
+    return len(items)
+
+
+def close_expired_items(closes_before: Optional[datetime] = None) -> int:
+    """
+    Close all the items past their closing time, :data:`CLOSE_ITEMS_BATCH_SIZE` at a time.
+
+    :param closes_before: Close items closing before this, defaults to now.
+    :return: Number of items closed by this call.
+    """
+
+    closes_before = closes_before or datetime.utcnow()
+    count = 0
+    while True:
+        items = list(Item.objects(closed__ne=True, closes_at__lt=closes_before)
+                     .only('title', 'seller', 'closes_at', 'leading_bid')
+                     .no_dereference()
+                     .order_by('closes_at')
+                     .limit(CLOSE_ITEMS_BATCH_SIZE))
+        if not items:
+            return count
+
+        count += close_items(items)
 
 
 def get_item_price(item: Item) -> int:
@@ -137,28 +410,416 @@ def get_item_price(item: Item) -> int:
     :return: The current price.
     """
 
-    winning_bid = get_winning_bid(item)
-    if winning_bid:
-        return winning_bid.amount
+    if item.current_price is not None:
+        return item.current_price
 
     return item.starting_bid
 
 
+@dataclasses.dataclass
+class BidResult:
+    """
+    Outcome of :func:`place_bid`.
+    """
+    success: bool
+
+    min_amount: int
+    "Smallest amount that would currently be accepted."
+
+    bid: Optional[Bid] = None
+    "The placed bid, if successful."
+
+    error: Optional[str] = None
+    "Reason for rejecting the bid."
+
+
+def biddable_items(item_id, amount: int):
+    """
+    Return a queryset matching the item, if a bid of `amount` would beat its
+    current price and the item is open.
+    """
+    return Item.objects(
+        Q(current_price=None, starting_bid__lte=amount - MIN_BID_INCREMENT)
+        | Q(current_price__lte=amount - MIN_BID_INCREMENT),
+        id=item_id,
+        closed__ne=True,
+        closes_at__gt=datetime.utcnow(),
+    )
+
+
+def save_bid(bid: Bid) -> bool:
+    """
+    Insert a new bid, retrying up to :data:`BID_SAVE_RETRIES` times on
+    connection errors.
+
+    An attempt may have been stored even though it reported an error, so a
+    duplicate key on a retry means the bid is stored. If the bid can't be
+    saved, a copy stored by an earlier attempt is deleted, so that no bid is
+    left behind for a failed placement.
+
+    :param bid: The bid, with its id set.
+    :return: True if the bid is stored.
+    """
+    log_extra = {'item_id': bid._data['item'].id, 'amount': bid.amount}  # pylint: disable=protected-access
+
+    for attempt in range(1, BID_SAVE_RETRIES + 1):
+        try:
+            bid.save(force_insert=True)
+            return True
+        except (NotUniqueError, DuplicateKeyError) as exc:
+            if attempt > 1:
+                logger.info("Bid %s was stored by an earlier attempt", bid.id, extra=log_extra)
+                return True
+            logger.warning("Error saving bid: %s", exc, exc_info=True, extra=log_extra)
+            break
+        except AutoReconnect as exc:
+            logger.warning("Error saving bid (attempt %d): %s", attempt, exc, exc_info=True, extra=log_extra)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error saving bid: %s", exc, exc_info=True, extra=log_extra)
+            break
+
+    try:
+        Bid.objects(id=bid.id).delete()
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.error("Error deleting unsaved bid %s: %s", bid.id, exc, exc_info=True, extra=log_extra)
+    return False
+
+
+def place_bid(item: Item, bidder, amount: int) -> BidResult:
+    """
+    Place a bid on an item.
+
+    The bid is stored first with :func:`save_bid`, and only then is the item's
+    current price compared and set in a single conditional update. The leading
+    bid of an item therefore always exists. A bid that has been outbid in the
+    meantime is deleted again.
+
+    :param item: The item to bid on.
+    :param bidder: The user placing the bid.
+    :param amount: The bid amount in `REF_CURRENCY`.
+    :return: The outcome, including the new minimum amount if the bid was rejected.
+    """
+
+    bid = Bid(id=ObjectId(), item=item, bidder=bidder, amount=amount)
+
+    if not save_bid(bid):
+        return BidResult(False, amount, error=_("Error placing bid, please try again."))
+
+    updated = biddable_items(item.id, amount).update_one(
+        set__leading_bid=bid,
+        set__current_price=amount,
+        inc__bid_count=1,
+        set__updated_at=datetime.utcnow(),
+    )
+
+    if not updated:
+        # Not the leading bid, so nothing refers to it yet.
+        try:
+            bid.delete()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Error deleting rejected bid %s: %s", bid.id, exc, exc_info=True)
+
+        # Find out why the bid lost; the price might have moved since the item was loaded.
+        item.reload('current_price', 'starting_bid', 'closed', 'closes_at')
+        min_amount = get_item_price(item) + MIN_BID_INCREMENT
+        if not item.is_open:
+            return BidResult(False, min_amount, error=_("This item is no longer on sale."))
+        return BidResult(False, min_amount,
+                         error=_("Bid must be at least %(min_amount)s", min_amount=min_amount))
+
+    item.leading_bid = bid
+    item.current_price = amount
+    publish_bid(bid)
+    return BidResult(True, amount + MIN_BID_INCREMENT, bid=bid)
+
+
+def place_bids(bidder, entries: list[tuple[str, int]]) -> list[BidResult]:
+    """
+    Place many bids at once.
+
+    Batch version of :func:`place_bid`: all the items are loaded with one
+    query, and the bids are inserted with one insert. The price of each item is
+    then compared and set with a conditional update of its own, as the outcome
+    of each one is needed. Like in :func:`place_bid`, the bids are stored before
+    they become leading bids, and the rejected ones are deleted again.
+
+    Only the highest bid per item is placed.
+
+    :param bidder: The user placing the bids.
+    :param entries: List of (item id, amount) pairs.
+    :return: Result for each entry, in the same order.
+    """
+
+    results: list[Optional[BidResult]] = [None] * len(entries)
+
+    item_ids = set()
+    for item_id, _amount in entries:
+        if ObjectId.is_valid(item_id):
+            item_ids.add(ObjectId(item_id))
+
+    items = Item.objects.no_dereference() \
+        .only('starting_bid', 'current_price', 'closed', 'closes_at') \
+        .in_bulk(list(item_ids))
+
+    # Validate against the current prices, and pick the highest bid for each item.
+    bids: dict[ObjectId, tuple[int, Bid]] = {}
+    for i, (item_id, amount) in enumerate(entries):
+        item = items.get(ObjectId(item_id)) if ObjectId.is_valid(item_id) else None
+        if item is None:
+            results[i] = BidResult(False, 0, error=_("Item not found."))
+            continue
+
+        min_amount = get_item_price(item) + MIN_BID_INCREMENT
+        if not item.is_open:
+            results[i] = BidResult(False, min_amount, error=_("This item is no longer on sale."))
+        elif amount < min_amount:
+            results[i] = BidResult(False, min_amount,
+                                   error=_("Bid must be at least %(min_amount)s", min_amount=min_amount))
+        elif item.id in bids and bids[item.id][1].amount >= amount:
+            results[i] = BidResult(False, bids[item.id][1].amount + MIN_BID_INCREMENT,
+                                   error=_("Outbid by a higher bid in the same request."))
+        else:
+            if item.id in bids:
+                previous_index, previous_bid = bids[item.id]
+                results[previous_index] = BidResult(False, amount + MIN_BID_INCREMENT,
+                                                    error=_("Outbid by a higher bid in the same request."))
+            bids[item.id] = (i, Bid(id=ObjectId(), item=item, bidder=bidder, amount=amount))
+
+    if bids:
+        try:
+            Bid.objects.insert([bid for _, bid in bids.values()], load_bulk=False)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error saving bids: %s", exc, exc_info=True)
+            # Some of them might have been stored before the error.
+            try:
+                Bid.objects(id__in=[bid.id for _, bid in bids.values()]).delete()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Error deleting bids: %s", exc, exc_info=True)
+            for index, bid in bids.values():
+                results[index] = BidResult(False, bid.amount, error=_("Error placing bid, please try again."))
+            return results
+
+        now = datetime.utcnow()
+        accepted = []
+        rejected = {}
+        for item_id, (index, bid) in bids.items():
+            updated = Item._get_collection().find_one_and_update(  # pylint: disable=protected-access
+                biddable_items(item_id, bid.amount)._query,  # pylint: disable=protected-access
+                {
+                    '$set': {'leading_bid': bid.id, 'current_price': bid.amount, 'updated_at': now},
+                    '$inc': {'bid_count': 1},
+                },
+                projection={'_id': True},
+            )
+            if updated is None:
+                rejected[item_id] = (index, bid)
+            else:
+                accepted.append(bid)
+                results[index] = BidResult(True, bid.amount + MIN_BID_INCREMENT, bid=bid)
+
+        if rejected:
+            # Not leading bids, so nothing refers to them.
+            try:
+                Bid.objects(id__in=[bid.id for _, bid in rejected.values()]).delete()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Error deleting rejected bids: %s", exc, exc_info=True)
+
+            # Find out why the bids lost; the prices might have moved since the items were loaded.
+            for item in Item.objects(id__in=list(rejected)).no_dereference() \
+                    .only('starting_bid', 'current_price', 'closed', 'closes_at'):
+                index, bid = rejected[item.id]
+                min_amount = get_item_price(item) + MIN_BID_INCREMENT
+                if not item.is_open:
+                    results[index] = BidResult(False, min_amount, error=_("This item is no longer on sale."))
+                else:
+                    results[index] = BidResult(False, min_amount,
+                                               error=_("Bid must be at least %(min_amount)s", min_amount=min_amount))
+
+        for bid in accepted:
+            publish_bid(bid)
+
+    # Items deleted while the bids were being placed
+    return [result or BidResult(False, 0, error=_("Item not found.")) for result in results]
+
+
+def serialize_bid(bid: Bid) -> dict:
+    """
+    Return the bid as a JSON serializable dict.
+
+    References are given as ids, so they are not dereferenced.
+    """
+    data = bid.to_mongo()
+    return {
+        'id': str(bid.id),
+        'item': str(data['item']),
+        'bidder': str(data['bidder']),
+        'amount': bid.amount,
+        'created_at': bid.created_at.isoformat(),
+    }
+
+
+def item_channel(item_id) -> str:
+    """
+    Return the name of the event channel for the item.
+    """
+    return f"item:{item_id}"
+
+
+def publish_bid(bid: Bid):
+    """
+    Publish an accepted bid to the subscribers of the item's price stream.
+    """
+    data = serialize_bid(bid)
+    publish(item_channel(data['item']), 'bid', {
+        'item': data['item'],
+        'price': bid.amount,
+        'min_amount': bid.amount + MIN_BID_INCREMENT,
+        'bid': data,
+    })
+
+
+def get_item_etag(id, *extra) -> Optional[str]:
+    """
+    Return a weak ETag for the bidding state of an item.
+
+    Only the fields in :data:`ITEM_ETAG_FIELDS` are loaded, so checking
+    `If-None-Match` costs one small lookup.
+
+    :param id: The id of the item.
+    :param extra: Other values the response depends on, such as the user.
+    :return: The ETag, or None if the item does not exist.
+    """
+    if not ObjectId.is_valid(id):
+        return None
+
+    state = Item.objects(id=id).only(*ITEM_ETAG_FIELDS).as_pymongo().first()
+    if state is None:
+        return None
+
+    return _state_etag(state, extra)
+
+
+def item_etag(item: Item, *extra) -> str:
+    """
+    Return a weak ETag for the bidding state of an already loaded item.
+
+    Same as :func:`get_item_etag`, for when the item is needed anyway.
+    """
+    return _state_etag(item.to_mongo(), extra)
+
+
+def _state_etag(state: dict, extra) -> str:
+    # Items pass their closing time before they are closed.
+    closes_at = state.get('closes_at')
+    is_open = not state.get('closed') and closes_at is not None and closes_at > datetime.utcnow()
+
+    parts = [state.get(field) for field in ITEM_ETAG_FIELDS] + [is_open, *extra]
+    return generate_etag(repr(parts).encode())
+
+
+def not_modified(etag: str) -> Response:
+    """
+    Return a 304 response for the ETag.
+    """
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@bp.cli.command("backfill-prices")
+def backfill_prices():
+    """
+    Populate the leading bid, current price and bid count of items bid on
+    before they were maintained on bid placement:
+        $ flask items backfill-prices
+
+    The scheduler leader runs this once per database on startup, see
+    :func:`~tjts5901.scheduler.init_scheduler`. Run it by hand when the
+    scheduler is disabled.
+    """
+
+    count = backfill_item_prices()
+    click.echo(f'Done, {count} items updated.')
+
+
+def encode_item_cursor(item: Item) -> str:
+    """
+    Return a pagination cursor pointing to the given item in the listing.
+    """
+    return f"{item.closes_at.isoformat()}_{item.id}"
+
+
+def decode_item_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    """
+    Parse a cursor made by :func:`encode_item_cursor`.
+
+    Aborts with 400 if the cursor is malformed.
+    """
+    try:
+        closes_at, item_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(closes_at), ObjectId(item_id)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.debug("Invalid cursor %r: %s", cursor, exc)
+        abort(400)
+
+
+def encode_bid_cursor(bid: Bid) -> str:
+    """
+    Return a pagination cursor pointing to the given bid in the bid history.
+    """
+    return f"{bid.amount}_{bid.created_at.isoformat()}"
+
+
+def decode_bid_cursor(cursor: str) -> tuple[int, datetime]:
+    """
+    Parse a cursor made by :func:`encode_bid_cursor`.
+
+    Aborts with 400 if the cursor is malformed.
+    """
+    try:
+        amount, created_at = cursor.split("_", 1)
+        return int(amount), datetime.fromisoformat(created_at)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.debug("Invalid cursor %r: %s", cursor, exc)
+        abort(400)
+
+
 @bp.route("/", methods=('GET', 'POST'))
 @login_required
 def index():
     """
-    Shows all the items for sale in the same view.
+    Shows the open items for sale, soonest closing first.
+
+    Items are paginated using a cursor on (`closes_at`, `id`), given in the
+    `after` query parameter.
     """
     if request.method == 'POST':
         bid_price = request.form['bid']
         id = request.form['itemId']
 
-    items = Item.objects.all()
-    #items.delete()
-    
+    items = Item.objects(closed__ne=True, closes_at__gt=datetime.utcnow())
+
+    if cursor := request.args.get('after'):
+        closes_at, item_id = decode_item_cursor(cursor)
+        items = items.filter(Q(closes_at__gt=closes_at) | Q(closes_at=closes_at, id__gt=item_id))
+
+    # Fetch one extra item to know if there is a next page.
+    items = list(items.order_by('closes_at', 'id')
+                 .only(*ITEM_LISTING_FIELDS)
+                 .no_dereference()
+                 .limit(ITEMS_PER_PAGE + 1))
+
+    next_cursor = None
+    if len(items) > ITEMS_PER_PAGE:
+        items = items[:ITEMS_PER_PAGE]
+        next_cursor = encode_item_cursor(items[-1])
+
+    # Load all the sellers on the page with one query.
+    prefetch_references(items, 'seller', known=[current_user._get_current_object()])
+
     return render_template('items/index.html',
-        items=items)
+        items=items, next_cursor=next_cursor)
 
 @bp.route('/sell', methods=('GET', 'POST'))
 @login_required
@@ -216,10 +877,23 @@ def view(id):
     Item view page.
 
     Displays the item details, and a form to place a bid.
+
+    Revalidations with `If-None-Match` are answered with 304 from the item
+    state, without loading its bids or rendering the page.
     """
 
     item = get_item(id)
 
+    # The page also depends on the user, their locale, and the notifications
+    # shown on it. Pages with flashed messages are not cached, as the messages
+    # are shown only once.
+    etag = None
+    if request.method == 'GET' and not session.get('_flashes'):
+        etag = item_etag(item, current_user.get_id(), str(get_locale()), getattr(current_user, 'currency', None),
+                         getattr(current_user, 'unread_notifications', None))
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
     # Print item id for debugging
     print("Item ID: ")
     print(item.id)
@@ -244,7 +918,11 @@ def view(id):
             else:
                 flash(_("This item is no longer on sale."))
 
-    return render_template('items/view.html', item=item, min_bid=min_bid)
+    response = make_response(render_template('items/view.html', item=item, min_bid=min_bid))
+    if etag and not session.get('_flashes'):
+        response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @bp.route('/item/<id>/update', methods=('GET', 'POST'))
@@ -269,6 +947,7 @@ def update(id):
         try:
             item.title = title
             item.description = description
+            item.updated_at = datetime.utcnow()
             item.save()
         except Exception as exc:
             error = _("Error updating item: %(exc)s", exc=exc)
@@ -316,7 +995,7 @@ def bid(id):
     :return: A redirect to the item view page.
     """
 
-    item = Item.objects.get_or_404(id=id)
+    item = get_item(id)
     min_amount = get_item_price(item)
     amount = int(request.form['amount'])
 
@@ -329,44 +1008,165 @@ def bid(id):
         flash("This item is no longer on sale.")
         return redirect(url_for('items.view', id=id))
 
-    try:
-        # Notice: if you have integrated the flask-login extension, use current_user
-        # instead of g.user
-        bid = Bid(
-            item=item,
-            bidder=current_user,
-            amount=amount,
-        )
-        bid.save()
-    except Exception as exc:
-        flash(f"Error placing bid: {exc!s}")
-    else:
+    # Notice: if you have integrated the flask-login extension, use current_user
+    # instead of g.user
+    result = place_bid(item, current_user, amount)
+    if result.success:
         flash(_("Bid placed successfully!"))
-
+    else:
+        flash(result.error)
 
     return redirect(url_for('items.view', id=id))
 
 
+@api.route('bids', methods=('POST',))
+@login_required
+def api_place_bids():
+    """
+    Place many bids at once.
+
+    Expects a JSON body with a list of bids::
+        {"bids": [{"item": "<item id>", "amount": 100}, ...]}
+
+    Only accepts `REF_CURRENCY` bids.
+
+    :return: A JSON response with a result for each bid, in the same order.
+    """
+
+    try:
+        entries = [(str(entry['item']), int(entry['amount']))
+                   for entry in request.get_json()['bids']]
+    except Exception as exc:  # pylint: disable=broad-except
+        return jsonify({
+            'success': False,
+            'error': _("Error parsing argument %(argname)s: %(exc)s", argname='bids', exc=exc)
+        })
+
+    if len(entries) > MAX_BATCH_BIDS:
+        return jsonify({
+            'success': False,
+            'error': _("At most %(count)s bids can be placed at once.", count=MAX_BATCH_BIDS)
+        })
+
+    results = []
+    for (item_id, _amount), result in zip(entries, place_bids(current_user._get_current_object(), entries)):
+        results.append({
+            'item': item_id,
+            'success': result.success,
+            'min_amount': result.min_amount,
+            'error': result.error,
+            'bid': serialize_bid(result.bid) if result.bid else None,
+        })
+
+    return jsonify({
+        'success': True,
+        'results': results,
+    })
+
+
 @api.route('<id>/bids', methods=('GET',))
 @login_required
 def api_item_bids(id):
     """
-    Get the bids for an item.
+    Get the bids for an item, highest first.
+
+    Bids are paginated using a cursor on (`amount`, `created_at`), given in the
+    `after` query parameter, and the page size in `limit`. The response is
+    streamed, so large pages are not held in memory.
 
     :param id: The id of the item to get bids for.
-    :return: A JSON response containing the bids.
+    :return: A JSON response containing the bids, and `next_cursor` for the
+        next page, or null on the last page.
     """
 
-    item = Item.objects.get_or_404(id=id)
-    bids = []
-    for bid in Bid.objects(item=item).order_by('-amount'):
-        bids.append(bid.to_json())
+    etag = get_item_etag(id)
+    if etag and request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
 
-    return jsonify({
-        'success': True,
-        'bids': bids
+    item = get_item(id)
+
+    try:
+        limit = int(request.args.get('limit', BIDS_PER_PAGE))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_BIDS_PER_PAGE:
+        abort(400)
+
+    bids = Bid.objects(item=item.id)
+    if cursor := request.args.get('after'):
+        amount, created_at = decode_bid_cursor(cursor)
+        bids = bids.filter(Q(amount__lt=amount) | Q(amount=amount, created_at__lt=created_at))
+
+    # Fetch one extra bid to know if there is a next page.
+    bids = bids.order_by('-amount', '-created_at').no_dereference().limit(limit + 1)
+
+    def generate():
+        yield '{"success": true, "bids": ['
+        last = None
+        for count, bid in enumerate(bids):
+            if count == limit:
+                break
+            yield (',' if last else '') + json.dumps(serialize_bid(bid))
+            last = bid
+        else:
+            last = None
+
+        next_cursor = encode_bid_cursor(last) if last else None
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    if etag:
+        response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@api.route('<id>/events', methods=('GET',))
+@login_required
+def api_item_events(id):
+    """
+    Stream the price of an item as Server-Sent Events.
+
+    Starts with the current price as a `price` event, followed by a `bid`
+    event for each accepted bid. The stream ends with a `closed` event when
+    the auction closes.
+
+    :param id: The id of the item.
+    """
+
+    # Subscribe before loading the item, so no bid is missed in between.
+    broadcaster = get_broadcaster()
+    subscription = broadcaster.subscribe(item_channel(id))
+    try:
+        item = get_item(id)
+    except HTTPException:
+        broadcaster.unsubscribe(subscription)
+        raise
+
+    if item.closed:
+        winning_bid = get_winning_bid(item)
+        initial = [('closed', {
+            'item': str(item.id),
+            'winning_bid': serialize_bid(winning_bid) if winning_bid else None,
+        })]
+    else:
+        price = get_item_price(item)
+        initial = [('price', {
+            'item': str(item.id),
+            'price': price,
+            'min_amount': price + MIN_BID_INCREMENT,
+        })]
+
+    events = stream_events(broadcaster, subscription, initial,
+                           keepalive=current_app.config['EVENT_STREAM_KEEPALIVE'],
+                           until=('closed',))
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Don't let nginx buffer the stream.
+        'X-Accel-Buffering': 'no',
     })
 
+
 @api.route('<id>/bids', methods=('POST',))
 @login_required
 def api_item_place_bid(id):
@@ -382,7 +1182,7 @@ def api_item_place_bid(id):
     :return: A JSON response containing the bid.
     """
 
-    item = Item.objects.get_or_404(id=id)
+    item = get_item(id)
     min_amount = get_item_price(item)
 
     try:
@@ -415,26 +1215,15 @@ def api_item_place_bid(id):
             'error': _("This item is no longer on sale.")
         })
 
-    try:
-        bid = Bid(
-            item=item,
-            bidder=current_user,
-            amount=amount,
-        )
-        bid.save()
-    except Exception as exc:
-        logger.error("Error placing bid: %s", exc, exc_info=True, extra={
-            'item_id': item.id,
-            'bidder_id': current_user.id,
-            'amount': amount,
-        })
-
+    result = place_bid(item, current_user, amount)
+    if not result.success:
         return jsonify({
             'success': False,
-            'error': _("Error placing bid: %(exc)s", exc=exc)
+            'error': result.error,
+            'min_amount': result.min_amount,
         })
 
     return jsonify({
         'success': True,
-        'bid': bid.to_mongo().to_dict()
-    })
\ No newline at end of file
+        'bid': serialize_bid(result.bid)
+    })
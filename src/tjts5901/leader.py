@@ -0,0 +1,134 @@
+"""
+Leader election
+===============
+
+Leases for electing one process to run the periodic jobs, when the application
+runs in several workers or replicas.
+
+:class:`MongoLease` is shared through the database, and works across hosts.
+:class:`FileLease` uses a lock file, and works for workers on a single host.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+from typing import Optional
+from uuid import uuid4
+
+from flask import Flask
+from mongoengine.connection import get_db
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class Lease:
+    """
+    Interface for a lease that at most one process holds at a time.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        "Identifies this process as the holder of the lease."
+
+    def acquire(self) -> bool:
+        """
+        Acquire the lease, or renew it if already held.
+
+        :return: True if this process holds the lease.
+        """
+        raise NotImplementedError
+
+    def release(self):
+        """
+        Give up the lease, if held.
+        """
+        raise NotImplementedError
+
+
+class MongoLease(Lease):
+    """
+    Lease stored in a MongoDB collection, expiring unless renewed within `ttl`.
+
+    Renew it well within the ttl. Expiry is compared against the clock of each
+    process, so the ttl should also cover the clock skew between hosts.
+    """
+
+    def __init__(self, name: str, ttl: timedelta, collection: str = "leases"):
+        super().__init__(name)
+        self.ttl = ttl
+        self.collection = collection
+
+    def acquire(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            lease = get_db()[self.collection].find_one_and_update(
+                {'_id': self.name, '$or': [{'holder': self.holder}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'holder': self.holder, 'expires_at': now + self.ttl}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Held by another process.
+            return False
+
+        return lease['holder'] == self.holder
+
+    def release(self):
+        get_db()[self.collection].delete_one({'_id': self.name, 'holder': self.holder})
+
+
+class FileLease(Lease):
+    """
+    Lease held with an exclusive lock on a file, until released or the process exits.
+    """
+
+    def __init__(self, name: str, path: str):
+        super().__init__(name)
+        self.path = path
+        self._file = None
+
+    def acquire(self) -> bool:
+        import fcntl  # pylint: disable=import-outside-toplevel
+
+        if self._file is None:
+            file = open(self.path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                file.close()
+                return False
+            self._file = file
+
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def create_lease(app: Flask, name: str) -> Optional[Lease]:
+    """
+    Create the lease configured in `SCHEDULER_LEASE`.
+
+    `SCHEDULER_LEASE` is "mongo" (default), "file", or None to let every
+    process run the jobs.
+    """
+    app.config.setdefault('SCHEDULER_LEASE', 'mongo')
+    app.config.setdefault('SCHEDULER_LEASE_TTL', 30)
+    "Seconds until the lease of a silent leader expires."
+
+    app.config.setdefault('SCHEDULER_LOCK_FILE', os.path.join(app.instance_path, 'scheduler.lock'))
+
+    kind = app.config['SCHEDULER_LEASE']
+    if kind == 'mongo':
+        return MongoLease(name, timedelta(seconds=app.config['SCHEDULER_LEASE_TTL']))
+    if kind == 'file':
+        return FileLease(name, app.config['SCHEDULER_LOCK_FILE'])
+    if kind:
+        raise ValueError(f"Unknown SCHEDULER_LEASE {kind!r}")
+    return None
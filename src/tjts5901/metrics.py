@@ -0,0 +1,368 @@
+"""
+Metrics
+=======
+
+Counters, gauges and histograms exposed in the Prometheus text format at
+`METRICS_ENDPOINT` (``/metrics`` by default). The endpoint is only exposed when
+`METRICS_TOKEN` is set, and scrapers send the token as a bearer token::
+
+    Authorization: Bearer <METRICS_TOKEN>
+
+Request latency and the requests in flight are recorded per endpoint, and
+MongoDB commands per collection through a pymongo command listener. Other
+modules define their own metrics with :func:`counter`, :func:`gauge` and
+:func:`histogram`::
+
+    >>> RELOADS = counter("reloads_total", "Number of reloads.", ("result",))
+    >>> RELOADS.inc(result="ok")
+
+Metrics are kept per process. When running several workers, each of them is
+scraped separately.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import hmac
+import logging
+import math
+import threading
+from time import monotonic
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from flask import Flask, Response, current_app, g, request
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"Histogram buckets in seconds, from a fast query to a very slow request."
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"Content type of the Prometheus text format."
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base class for metrics with a value for each combination of label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Sample]:
+        """
+        Yield the name, labels and value of each sample.
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format.
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}"
+                     for name, labels, value in self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    Value that only goes up, like the number of requests.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Increase the counter of the labels by `amount`.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, like the number of requests in flight.
+    """
+
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Increase the gauge of the labels by `amount`.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """
+        Decrease the gauge of the labels by `amount`.
+        """
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        """
+        Set the gauge of the labels.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, like request latencies, in cumulative buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """
+        Record an observed value.
+        """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            if (entry := self._values.get(key)) is None:
+                # Counts per bucket, the last one for +Inf, and the sum.
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the time spent in the with block, in seconds.
+        """
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started, **labels)
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    """
+    Collection of the metrics to expose.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add a metric, raising :class:`ValueError` if the name is taken.
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Metric:
+        """
+        Return a registered metric by its name.
+        """
+        return self._metrics[name]
+
+    def render(self) -> str:
+        """
+        Render all the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            metrics: List[Metric] = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+registry = Registry()
+"Metrics of this process."
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """
+    Create and register a :class:`Counter`.
+    """
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """
+    Create and register a :class:`Gauge`.
+    """
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """
+    Create and register a :class:`Histogram`.
+    """
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+REQUEST_DURATION = histogram(
+    "http_request_duration_seconds", "Time spent handling requests.", ("endpoint", "method"))
+REQUESTS = counter(
+    "http_requests_total", "Requests handled, by response status.", ("endpoint", "method", "status"))
+REQUESTS_IN_FLIGHT = gauge(
+    "http_requests_in_flight", "Requests being handled.", ("endpoint",))
+
+MONGODB_COMMAND_DURATION = histogram(
+    "mongodb_command_duration_seconds", "Time spent on MongoDB commands.", ("command", "collection"))
+MONGODB_COMMAND_FAILURES = counter(
+    "mongodb_command_failures_total", "MongoDB commands that failed.", ("command", "collection"))
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Records the count and duration of MongoDB commands, per collection.
+    """
+
+    def __init__(self):
+        self._collections: Dict[int, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def _finished(self, event) -> Dict[str, str]:
+        labels = {
+            "command": event.command_name,
+            "collection": self._collections.pop(event.request_id, ""),
+        }
+        MONGODB_COMMAND_DURATION.observe(event.duration_micros / 1e6, **labels)
+        return labels
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        MONGODB_COMMAND_FAILURES.inc(**self._finished(event))
+
+
+command_metrics = CommandMetrics()
+"Listener of the MongoDB commands, registered for clients created after :func:`init_metrics`."
+
+_command_metrics_registered = False
+
+
+def init_metrics(app: Flask):
+    """
+    Record request and MongoDB metrics, and expose them at `METRICS_ENDPOINT`.
+
+    Meant to be called before the database is connected, so that the command
+    listener applies to the connection.
+    """
+    global _command_metrics_registered  # pylint: disable=global-statement
+
+    app.config.setdefault('METRICS_ENDPOINT', '/metrics')
+    "URL of the metrics in the Prometheus text format, or None to not expose them."
+
+    app.config.setdefault('METRICS_TOKEN', None)
+    "Bearer token required to read the metrics. They are not exposed without one."
+
+    if not _command_metrics_registered:
+        monitoring.register(command_metrics)
+        _command_metrics_registered = True
+
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+
+    if (endpoint := app.config['METRICS_ENDPOINT']) and app.config['METRICS_TOKEN']:
+        app.add_url_rule(endpoint, 'metrics', metrics)
+
+
+def _start_request():
+    endpoint = request.endpoint or "<unmatched>"
+    g.metrics_request = (endpoint, monotonic())
+    REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+
+
+def _record_status(response: Response) -> Response:
+    g.metrics_status = response.status_code
+    return response
+
+
+def _finish_request(exc):  # pylint: disable=unused-argument
+    if (started := g.pop('metrics_request', None)) is None:
+        return
+    endpoint, started_at = started
+    REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+    REQUEST_DURATION.observe(monotonic() - started_at, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=g.pop('metrics_status', 500))
+
+
+def metrics() -> Response:
+    """
+    Metrics of this process in the Prometheus text format.
+
+    Requires the `METRICS_TOKEN` as a bearer token.
+    """
+    expected = f"Bearer {current_app.config['METRICS_TOKEN']}"
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected.encode()):
+        return Response("Unauthorized\n", status=401, headers={'WWW-Authenticate': 'Bearer'},
+                        content_type='text/plain')
+
+    return Response(registry.render(), content_type=CONTENT_TYPE)
@@ -4,16 +4,18 @@ from secrets import token_urlsafe
 from mongoengine import (
     StringField,
     IntField,
-    ReferenceField,
     DateTimeField,
     EmailField,
     BooleanField,
     EnumField,
+    ObjectIdField,
 )
 
 from .i18n import SupportedLocales
 
 from .db import db
+# References are resolved through the request's identity map.
+from .db import MappedReferenceField
 from flask_login import UserMixin
 from bson import ObjectId
 
@@ -41,6 +43,9 @@ class User(UserMixin, db.Document):
     is_disabled = BooleanField(default=False)
     "Whether the user is disabled, banned in practical terms"
 
+    unread_notifications = IntField()
+    "Number of unread notifications, or None if not counted yet."
+
     @property
     def is_active(self) -> bool:
         """
@@ -63,10 +68,12 @@ class Item(db.Document):
     Model representing an item in the auction.
     """
 
-    # Create index for sorting items by closing time, as Azure MondoDB does not do it automatically
+    # Create index for sorting items by closing time, as Azure MondoDB does not do it automatically.
+    # Id is included so that the item listing can be paginated with a stable order.
     meta = {"indexes": [
         {"fields": [
             "closes_at",
+            "id",
         ]}
     ]}
 
@@ -74,15 +81,29 @@ class Item(db.Document):
     description = StringField(max_length=1500, required=True)
 
     starting_bid = IntField(required=True, min_value=0)
-    leading_bid = ReferenceField("Bid")
-    winning_bid = ReferenceField("Bid")
+    leading_bid = MappedReferenceField("Bid")
+    "Currently highest bid. Maintained atomically when bids are placed."
+
+    current_price = IntField(min_value=0)
+    "Amount of the :attr:`leading_bid`, or None if there are no bids yet."
+
+    bid_count = IntField(default=0, min_value=0)
+    "Number of accepted bids. Maintained atomically when bids are placed."
 
-    seller = ReferenceField(User, required=True)
+    winning_bid = MappedReferenceField("Bid")
+
+    seller = MappedReferenceField(User, required=True)
     closed = BooleanField(default=False)
 
     created_at = DateTimeField(required=True, default=datetime.utcnow())
     closes_at = DateTimeField()
 
+    closing_id = ObjectIdField()
+    "Id of the bulk closing run that closed the item, see :func:`~tjts5901.items.close_items`."
+
+    updated_at = DateTimeField(default=datetime.utcnow)
+    "Date and time that the item, or its bids, last changed."
+
     @property
     def is_open(self) -> bool:
         """
@@ -103,16 +124,22 @@ class Bid(db.Document):
             "amount",
             "item",
             "created_at",
-        ]}
+        ]},
+        # Bid history of an item, highest first.
+        {"fields": [
+            "item",
+            "-amount",
+            "-created_at",
+        ]},
     ]}
 
     amount = IntField(required=True, min_value=0)
     "Indicates the value of the bid."
 
-    bidder = ReferenceField(User, required=True)
+    bidder = MappedReferenceField(User, required=True)
     "User who placed the bid."
 
-    item = ReferenceField(Item, required=True)
+    item = MappedReferenceField(Item, required=True)
     "Item that the bid is for."
 
     created_at = DateTimeField(required=True, default=datetime.utcnow)
@@ -134,7 +161,7 @@ class Notification(db.Document):
 
     id: ObjectId
 
-    user = ReferenceField(User, required=True)
+    user = MappedReferenceField(User, required=True)
 
     category = StringField(max_length=100, default="message")
     message = StringField(required=True)
@@ -163,7 +190,7 @@ class AccessToken(db.Document):
     name = StringField(max_length=100, required=True)
     "Human-readable name for the token."
 
-    user = ReferenceField(User, required=True)
+    user = MappedReferenceField(User, required=True)
     "User that the token is for."
 
     token = StringField(required=True, unique=True, default=token_urlsafe)
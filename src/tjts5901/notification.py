@@ -1,17 +1,30 @@
+import atexit
+from collections import Counter
 import dataclasses
 from datetime import datetime
 import logging
+import queue
+import threading
+from time import monotonic, sleep
+from typing import Optional
 
-from flask import get_flashed_messages, Blueprint
+from bson import ObjectId
+from flask import Flask, current_app, get_flashed_messages, Blueprint
 from flask_login import current_user
 from flask_babel import force_locale, lazy_gettext
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+from .auth import invalidate_cached_users
 from .models import Notification, User
 
 bp = Blueprint('notification', __name__, url_prefix='/')
 
 logger = logging.getLogger(__name__)
 
+DUPLICATE_KEY_ERROR = 11000
+"MongoDB error code for a duplicate key."
+
 @dataclasses.dataclass
 class Message:
     """
@@ -29,29 +42,224 @@ class Message:
 def init_notification(app):
     """
     Initialize the notifications module.
+
+    Unless disabled with `NOTIFICATION_OUTBOX`, notifications are delivered
+    through a :class:`NotificationOutbox`. It is disabled by default when
+    testing, so notifications are saved right away.
     """
     app.register_blueprint(bp)
     app.jinja_env.globals.update(get_notifications=get_notifications)
 
+    app.config.setdefault('NOTIFICATION_OUTBOX', not app.testing)
+    app.config.setdefault('NOTIFICATION_OUTBOX_SIZE', 10000)
+    "Notifications queued before senders have to wait."
 
-def send_notification(user, message, category="message", title=None):
+    app.config.setdefault('NOTIFICATION_BATCH_SIZE', 500)
+    "Maximum number of notifications inserted at once."
+
+    if app.config['NOTIFICATION_OUTBOX']:
+        outbox = app.extensions['notification_outbox'] = NotificationOutbox(
+            app,
+            maxsize=app.config['NOTIFICATION_OUTBOX_SIZE'],
+            batch_size=app.config['NOTIFICATION_BATCH_SIZE'],
+        )
+        # Deliver the queued notifications before the process exits.
+        atexit.register(outbox.close)
+
+
+class NotificationOutbox:
     """
-    Send a notification to the given user.
+    Queue of notifications, inserted into the database in batches by a worker thread.
+
+    Senders only enqueue the message, so they don't wait for translating and
+    saving it. When the queue is full, senders wait up to `put_timeout`
+    seconds, and then deliver the notification themselves.
+    """
+
+    def __init__(self, app: Flask, maxsize: int = 10000, batch_size: int = 500,
+                 linger: float = 0.05, put_timeout: float = 5, retries: int = 3):
+        """
+        :param linger: Seconds to wait for more notifications to fill a batch.
+        :param retries: Attempts to insert a batch before it is dropped.
+        """
+        self._app = app
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.batch_size = batch_size
+        self.linger = linger
+        self.put_timeout = put_timeout
+        self.retries = retries
+
+    def put(self, user, message, category="message", title=None):
+        """
+        Queue a notification, see :func:`build_notification` for the arguments.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="notification-outbox", daemon=True)
+                self._thread.start()
+
+        entry = (user, message, category, title)
+        try:
+            self._queue.put(entry, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning("Notification outbox is full, delivering synchronously")
+            self._deliver([entry])
+
+    def flush(self):
+        """
+        Wait until the queued notifications have been delivered.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Deliver the queued notifications, and stop the worker thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            # Wait for the first notification, then collect a batch.
+            batch = [self._queue.get()]
+            deadline = monotonic() + self.linger
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                self._deliver([entry for entry in batch if entry is not None])
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Error delivering notifications: %s", exc, exc_info=True)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if batch[-1] is None:
+                return
+
+    def _deliver(self, entries: list):
+        if not entries:
+            return
+
+        with self._app.app_context():
+            notifications = []
+            for entry in entries:
+                try:
+                    notifications.append(build_notification(*entry).to_mongo())
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Error building notification: %s", exc, exc_info=True)
+
+            for attempt in range(1, self.retries + 1):
+                try:
+                    insert_notifications(notifications)
+                    return
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.warning("Error inserting notifications (attempt %d): %s", attempt, exc)
+                sleep(0.1 * attempt)
+
+            logger.error("Dropping %d notifications after %d attempts", len(notifications), self.retries)
+
+
+def insert_notifications(notifications: list[dict]):
+    """
+    Insert notifications, and count them in the recipients' unread counters.
+
+    Ids are given to the notifications first, so that retrying a partially
+    inserted batch is safe.
+
+    :param notifications: Notifications as returned by `to_mongo()`.
+    """
+
+    for notification in notifications:
+        notification.setdefault('_id', ObjectId())
+
+    try:
+        Notification._get_collection().insert_many(notifications, ordered=False)  # pylint: disable=protected-access
+    except BulkWriteError as exc:
+        # Already inserted by an earlier attempt.
+        errors = exc.details.get('writeErrors', [])
+        if not errors or not all(error['code'] == DUPLICATE_KEY_ERROR for error in errors):
+            raise
+
+    # Users whose counter is not set yet are counted when they next look.
+    unread = Counter(notification['user'] for notification in notifications)
+    User._get_collection().bulk_write([  # pylint: disable=protected-access
+        UpdateOne({'_id': user_id, 'unread_notifications': {'$exists': True}},
+                  {'$inc': {'unread_notifications': count}})
+        for user_id, count in unread.items()
+    ], ordered=False)
+    invalidate_cached_users(unread)
+
+
+def get_outbox() -> Optional[NotificationOutbox]:
+    """
+    Return the notification outbox of the current application, or None if disabled.
+    """
+    return current_app.extensions.get('notification_outbox')
+
+
+def build_notification(user, message, category="message", title=None) -> Notification:
+    """
+    Create a notification for the given user, without saving it.
+
+    The message and title are translated to the recipient's locale.
 
     :param user: The user to send the message to.
-    :param subject: The subject of the message.
     :param message: The message to send.
+    :param category: Category of the message.
+    :param title: The subject of the message.
     """
 
-    # Change the locale to the message recipient locale.
-    with force_locale(user.locale):
-        notification = Notification(
+    # Change the locale to the message recipient locale. Users who have not
+    # chosen one get the default locale.
+    locale = user.locale.value if user.locale else current_app.config['BABEL_DEFAULT_LOCALE']
+    with force_locale(locale):
+        return Notification(
             user=user,
             message=str(message),
             category=category,
             title=str(title),
         )
-        notification.save()
+
+
+def send_notification(user, message, category="message", title=None):
+    """
+    Send a notification to the given user.
+
+    Delivered through the outbox if enabled, otherwise saved right away.
+
+    :param user: The user to send the message to.
+    :param subject: The subject of the message.
+    :param message: The message to send.
+    """
+    if outbox := get_outbox():
+        outbox.put(user, message, category, title)
+    else:
+        insert_notifications([build_notification(user, message, category, title).to_mongo()])
+
+
+def send_notifications(notifications: list[dict]):
+    """
+    Send many notifications.
+
+    Without the outbox, they are inserted with one insert.
+
+    :param notifications: Keyword arguments of :func:`send_notification` for
+        each notification.
+    """
+    if outbox := get_outbox():
+        for notification in notifications:
+            outbox.put(**notification)
+    elif notifications:
+        insert_notifications([build_notification(**notification).to_mongo() for notification in notifications])
 
 
 def get_notifications(user: User = current_user) -> list[Message]:
@@ -61,7 +269,8 @@ def get_notifications(user: User = current_user) -> list[Message]:
     Flash messages are returned first, followed by database messages.
     Messages are marked as read when they are retrieved.
 
-    Notice: the listing query might not return recently added messages.
+    The database is only queried if the user's unread counter says there is
+    something new, so most pages need no query at all.
 
     :param user: The user to get the messages for.
     :return: A list of messages.
@@ -77,13 +286,34 @@ def get_notifications(user: User = current_user) -> list[Message]:
         logger.debug("User is not authenticated, returning flash messages.")
         return messages
 
+    unread = user.unread_notifications
+    if unread == 0:
+        return messages
+
+    users = User.objects(id=user.id)
+    if unread is None:
+        # Start counting. Notifications from before are found by the query below.
+        users.filter(unread_notifications=None).update_one(set__unread_notifications=0)
+
     # Get the database messages
-    notifications = Notification.objects(user=user, read_at=None).order_by('-created_at').all()
+    notifications = Notification.objects(user=user, read_at=None) \
+        .order_by('-created_at') \
+        .only('message', 'category', 'title')
 
+    shown = []
     for notification in notifications:
         messages.append(Message(notification.message, notification.category, notification.title))
+        shown.append(notification.id)
 
-    # Mark the messages as read
-    notifications.update(read_at=datetime.utcnow())
+    # Mark the messages shown as read, and take them off the counter.
+    read = Notification.objects(id__in=shown, read_at=None).update(read_at=datetime.utcnow()) if shown else 0
+    if read:
+        if not users.filter(unread_notifications__gte=read).update_one(dec__unread_notifications=read):
+            # Notifications from before counting started.
+            users.filter(unread_notifications__lt=read).update_one(set__unread_notifications=0)
+    elif unread:
+        # The counter was off; there was nothing unread.
+        users.filter(unread_notifications=unread).update_one(set__unread_notifications=0)
 
+    invalidate_cached_users([user.id])
     return messages
@@ -0,0 +1,100 @@
+"""
+Password hashing
+================
+
+Hashing passwords is deliberately slow. A burst of logins, like when a popular
+auction closes, would otherwise keep every request thread busy hashing.
+
+:class:`PasswordHasher` lets a limited number of hashes run at a time, and
+turns away the requests that have waited for a free slot for too long. The
+hashes run on the calling thread; hashlib releases the GIL while hashing, so
+the slots can be set to the number of cores.
+"""
+
+from functools import cached_property
+import os
+import threading
+
+from flask import Flask, current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when no hashing slot frees up within the queue timeout.
+    """
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords, at most `workers` at a time.
+
+    :param method: Werkzeug hash method, eg. "pbkdf2:sha256:260000".
+    :param workers: Number of passwords hashed at the same time.
+    :param queue_timeout: Seconds to wait for a free slot before giving up.
+    """
+
+    def __init__(self, method: str = "pbkdf2:sha256", workers: int = 1, queue_timeout: float = 10):
+        self.method = method
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(workers)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise PasswordHasherBusy()
+        try:
+            return func(*args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        """
+        Hash a password with the configured method.
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash: str, password: str) -> bool:
+        """
+        Check a password against a hash, made with any method.
+        """
+        return self._run(check_password_hash, pwhash, password)
+
+    @cached_property
+    def hash_prefix(self) -> str:
+        """
+        Method and parameters that hashes made now start with, defaults filled in.
+        """
+        return generate_password_hash("", self.method).split("$", 1)[0]
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """
+        Return whether the hash was made with other parameters than configured now.
+        """
+        return pwhash.split("$", 1)[0] != self.hash_prefix
+
+
+def init_passwords(app: Flask):
+    """
+    Set up the password hasher of the application.
+    """
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    "Werkzeug hash method and cost. Stored hashes are upgraded on login when changed."
+
+    app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+    "Number of passwords hashed at the same time."
+
+    app.config.setdefault('PASSWORD_HASH_QUEUE_TIMEOUT', 10)
+    "Seconds a request waits for its turn to hash, before being turned away."
+
+    app.extensions['password_hasher'] = PasswordHasher(
+        method=app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        queue_timeout=app.config['PASSWORD_HASH_QUEUE_TIMEOUT'],
+    )
+
+
+def get_password_hasher() -> PasswordHasher:
+    """
+    Return the password hasher of the current application.
+    """
+    return current_app.extensions['password_hasher']
@@ -0,0 +1,212 @@
+"""
+Rate table
+==========
+
+Compact, array-backed table of currency conversion rates.
+
+The ECB currency file can be compiled into a snapshot file: a NumPy array with a
+date column and one float64 column per currency. The snapshot is memory-mapped
+read-only, so all worker processes share the same pages, and loading it does
+not parse anything.
+
+:class:`RateTable` offers the parts of :class:`~currency_converter.CurrencyConverter`
+used by the application, with the same results.
+"""
+
+from datetime import date as date_type, datetime
+import io
+import json
+import logging
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Optional, Tuple
+from zipfile import ZipFile, is_zipfile
+
+import numpy as np
+from currency_converter import RateNotFoundError
+
+logger = logging.getLogger(__name__)
+
+NA_VALUES = {"", "N/A"}
+"Values used in the currency file for missing rates."
+
+
+def read_currency_file(currency_file: str, ref_currency: str) -> np.ndarray:
+    """
+    Parse the ECB currency file (csv, or zip containing the csv) into a rate table.
+
+    :param currency_file: Path to the currency file.
+    :param ref_currency: Currency the rates are relative to.
+    :return: Structured array with `date` field, and a rate field for each
+        currency, sorted by date. Missing rates are NaN.
+    """
+
+    if is_zipfile(currency_file):
+        with ZipFile(currency_file) as zf:
+            content = zf.read(zf.namelist().pop()).decode("utf-8")
+    else:
+        content = Path(currency_file).read_text(encoding="utf-8")
+
+    lines = io.StringIO(content)
+    header = [currency.strip() for currency in next(lines).strip().split(",")[1:]]
+    columns = [i for i, currency in enumerate(header) if currency]
+    currencies = [header[i] for i in columns]
+
+    dates = []
+    rows = []
+    for line in lines:
+        if not (line := line.strip()):
+            continue
+        values = line.split(",")
+        dates.append(np.datetime64(values[0], "D"))
+        rates = values[1:]
+        rows.append([np.nan if rates[i] in NA_VALUES else float(rates[i]) for i in columns])
+
+    dtype = [("date", "datetime64[D]"), (ref_currency, "f8")] + [(currency, "f8") for currency in currencies]
+    table = np.empty(len(rows), dtype=dtype)
+    table["date"] = dates
+    table[ref_currency] = 1.0
+    rates = np.array(rows, dtype=np.float64).reshape(len(rows), len(currencies))
+    for i, currency in enumerate(currencies):
+        table[currency] = rates[:, i]
+
+    return np.sort(table, order="date")
+
+
+def snapshot_source(currency_file: str) -> dict:
+    """
+    Identify the version of the currency file a snapshot is compiled from.
+    """
+    stat = os.stat(currency_file)
+    return {
+        'path': os.path.abspath(currency_file),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+    }
+
+
+def is_snapshot_current(currency_file: str, snapshot_file: str) -> bool:
+    """
+    Whether the snapshot exists, and was compiled from the current currency file.
+
+    Compares the source recorded next to the snapshot, so a currency file
+    replaced with an older one, or a different file, is also noticed.
+    """
+    try:
+        with open(snapshot_file + ".json", encoding="utf-8") as f:
+            source = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return os.path.exists(snapshot_file) and source == snapshot_source(currency_file)
+
+
+def compile_rate_snapshot(currency_file: str, snapshot_file: str, ref_currency: str):
+    """
+    Compile the currency file into a snapshot file.
+
+    The snapshot is written into a temporary file first, and moved in place, so
+    processes that have the previous snapshot mapped keep using it undisturbed.
+    The source of the snapshot is recorded in a `.json` file next to it, see
+    :func:`is_snapshot_current`.
+    """
+
+    # Before reading, so a file changed meanwhile is compiled again.
+    source = snapshot_source(currency_file)
+    table = read_currency_file(currency_file, ref_currency)
+
+    snapshot_dir = os.path.dirname(snapshot_file)
+    if snapshot_dir and not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    with NamedTemporaryFile(dir=snapshot_dir or None, suffix=".npy", delete=False) as f:
+        np.save(f, table, allow_pickle=False)
+
+    # Temporary files are private to the owner, but workers may run as other users.
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, snapshot_file)
+
+    with NamedTemporaryFile("w", dir=snapshot_dir or None, suffix=".json", delete=False, encoding="utf-8") as f:
+        json.dump(source, f)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, snapshot_file + ".json")
+    logger.info("Compiled currency snapshot %s with %d dates.", snapshot_file, len(table))
+
+
+class RateTable:
+    """
+    Currency converter backed by a rate table array.
+    """
+
+    def __init__(self, table: np.ndarray, ref_currency: str):
+        self._table = table
+        self._dates = table["date"]
+        self.ref_currency = ref_currency
+        self.currencies = set(table.dtype.names[1:])
+        self._last_index: Dict[str, int] = {}
+        self._rate_vector = None
+
+    @classmethod
+    def load(cls, snapshot_file: str, ref_currency: str) -> "RateTable":
+        """
+        Memory-map a snapshot made by :func:`compile_rate_snapshot`.
+        """
+        return cls(np.load(snapshot_file, mmap_mode="r", allow_pickle=False), ref_currency)
+
+    def _get_last_index(self, currency: str) -> int:
+        """
+        Return the row of the most recent rate of the currency.
+        """
+        if (index := self._last_index.get(currency)) is None:
+            known = np.flatnonzero(~np.isnan(self._table[currency]))
+            index = self._last_index[currency] = int(known[-1]) if len(known) else -1
+        return index
+
+    def _get_rate(self, currency: str, index: int) -> float:
+        rate = float(self._table[currency][index]) if index >= 0 else np.nan
+        if np.isnan(rate):
+            raise RateNotFoundError(f"{currency} has no rate for {self._dates[index]}")
+        return rate
+
+    def convert(self, amount, currency: str, new_currency: Optional[str] = None, date=None) -> float:
+        """
+        Convert amount from a currency to another one.
+
+        Same as :meth:`CurrencyConverter.convert`: if the date is not given, the
+        most recent rate of `currency` is used.
+        """
+
+        new_currency = new_currency or self.ref_currency
+        for c in currency, new_currency:
+            if c not in self.currencies:
+                raise ValueError(f"{c} is not a supported currency")
+
+        if date is None:
+            index = self._get_last_index(currency)
+        else:
+            if isinstance(date, datetime):
+                date = date.date()
+            day = np.datetime64(date if isinstance(date, date_type) else str(date), "D")
+            index = int(np.searchsorted(self._dates, day))
+            if index >= len(self._dates) or self._dates[index] != day:
+                raise RateNotFoundError(f"{currency} has no rate for {date}")
+
+        r0 = self._get_rate(currency, index)
+        r1 = self._get_rate(new_currency, index)
+
+        return float(amount) / r0 * r1
+
+    def get_rate_vector(self) -> Tuple[Dict[str, int], np.ndarray]:
+        """
+        Return the rates of the most recent date as a vector.
+
+        :return: Mapping of currency codes to indices, and the vector of rates.
+        """
+        if self._rate_vector is None:
+            index = self._get_last_index(self.ref_currency)
+            currencies = self._table.dtype.names[1:]
+            rates = np.array([self._table[currency][index] for currency in currencies], dtype=np.float64)
+            self._rate_vector = {currency: i for i, currency in enumerate(currencies)}, rates
+
+        return self._rate_vector
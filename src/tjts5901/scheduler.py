@@ -1,11 +1,23 @@
+import atexit
+import functools
 import logging
+import os
+import sys
+import threading
 from datetime import timedelta, datetime
 from random import randint
+from typing import Optional
 
-from mongoengine import signals, Q
+from bson import ObjectId
+from mongoengine import signals
+from mongoengine.connection import get_db
 
+from .closing import ClosingEngine
+from .events import Broadcaster, Subscription
+from .leader import Lease, create_lease
+from .metrics import histogram
 from .models import Item
-from .items import handle_item_closing
+from .items import backfill_item_prices, close_expired_items, handle_item_closing
 
 from flask_apscheduler import APScheduler
 from apscheduler.schedulers import SchedulerAlreadyRunningError
@@ -13,12 +25,79 @@ from apscheduler.schedulers import SchedulerAlreadyRunningError
 logger = logging.getLogger(__name__)
 scheduler = APScheduler()
 
+CLOSING_QUEUE_HORIZON = timedelta(minutes=2)
+"How far ahead the closing queue is refreshed from the database."
+
+MIGRATIONS_COLLECTION = "migrations"
+"Collection recording the data migrations run on the database."
+
+CLOSING_CHANNEL = "scheduler:closing"
+"""
+Channel of the `EVENT_BROADCASTER` for telling the leader about the closing
+times of items saved in other processes. Without a configured broadcaster,
+the leader finds them within :data:`CLOSING_QUEUE_HORIZON` of closing.
+"""
+
+JOB_DURATION = histogram("scheduler_job_duration_seconds", "Time spent running scheduled jobs.", ("job",))
+
+leader_lease: Optional[Lease] = None
+"Lease electing the process that runs the periodic jobs, None if every process runs them."
+
+is_leader = False
+"Whether this process runs the periodic jobs."
+
+closing_broadcaster: Optional[Broadcaster] = None
+"Broadcaster shared by the processes for :data:`CLOSING_CHANNEL`, None if not configured."
+
+
+def leader_only(func):
+    """
+    Decorate a job to run only in the leader process.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_leader:
+            logger.debug("Skipping %s, not the leader", func.__name__)
+            return None
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def is_server_process() -> bool:
+    """
+    Guess whether this process was started to serve the application, with
+    `flask run`, gunicorn or `python -m tjts5901`, rather than to run a CLI
+    command or a script importing the application.
+    """
+    if not sys.argv or not sys.argv[0]:
+        return False
+
+    program = os.path.basename(sys.argv[0])
+    if program == '__main__.py':
+        # Run with `python -m`.
+        program = os.path.basename(os.path.dirname(sys.argv[0]))
+    program = os.path.splitext(program)[0]
+
+    if program == 'flask':
+        return 'run' in sys.argv[1:]
+    return program in ('gunicorn', 'uwsgi', 'tjts5901')
+
+
 def init_scheduler(app):
     """
     Initialize the APScheduler extension.
 
+    The jobs and the closing engine only run when `SCHEDULER_ENABLED`, by default
+    in the processes serving the application. CLI commands and scripts don't
+    wait for the database to run them.
+
     This function is meant to be called from the create_app() function.
     """
+    global leader_lease, closing_broadcaster  # pylint: disable=global-statement
+
+    app.config.setdefault('SCHEDULER_ENABLED', is_server_process())
+    "Whether to run the scheduled jobs and close items in this process."
+
     try:
 
         scheduler.init_app(app)
@@ -26,11 +105,35 @@ def init_scheduler(app):
         # Due to the scheduler being utilised as global variable, check if
         # the scheduler is already running. If it is, then it means that the
         # scheduler has already been initialised.
-        if not scheduler.running and not app.config.get('TESTING'):
+        if not scheduler.running and not app.config.get('TESTING') and app.config['SCHEDULER_ENABLED']:
 
-            # Add a signal handler to schedule a task to close the item when the auction
-            # ends.
+            # Keep the closing queue up to date with the items saved and deleted in
+            # this process.
             signals.post_save.connect(_schedule_item_closing_task, sender=Item)
+            signals.post_delete.connect(_cancel_item_closing_task, sender=Item)
+
+            # Only the leader closes items, so the others tell it what they save,
+            # if there is a broadcaster reaching the other processes. The default
+            # one only delivers events within the process.
+            if app.config.get('EVENT_BROADCASTER') is not None:
+                closing_broadcaster = app.extensions['broadcaster']
+                subscription = closing_broadcaster.subscribe(CLOSING_CHANNEL)
+                threading.Thread(target=_follow_closing_events, args=(subscription,),
+                                 name="closing-events", daemon=True).start()
+
+            # Elect one process to run the jobs below, and renew its lease well
+            # before it expires. Starts right away, and lets go on exit.
+            leader_lease = create_lease(app, 'scheduler')
+            atexit.register(release_leadership)
+            scheduler.add_job(trigger='interval', seconds=app.config['SCHEDULER_LEASE_TTL'] / 3,
+                            next_run_time=datetime.now(),
+                            func=_renew_lease,
+                            id='renew-lease')
+
+            # Pick up items listed or edited in other processes before they close.
+            scheduler.add_job(trigger='interval', minutes=1,
+                            func=_refresh_closing_queue,
+                            id='refresh-closing-queue')
 
             # Add a batch task to close expired bids every 15 minutes. This is to ensure
             # that the bids are closed even if the server is restarted.
@@ -48,6 +151,8 @@ def init_scheduler(app):
                 scheduler.start()
                 logger.debug('APScheduler started')
 
+                closing_engine.start()
+
     except SchedulerAlreadyRunningError:
         logger.debug('APScheduler already running')
 
@@ -56,49 +161,216 @@ def init_scheduler(app):
     return app
 
 
-def _handle_item_closing(item_id):
+def _renew_lease():
     """
-    Handle the closing of an item.
+    Acquire or renew the leader lease.
+
+    The new leader runs the pending data migrations, and rebuilds its closing
+    queue, as items were closed by the previous leader until now.
 
     This function is meant to be run by the APScheduler, and is not meant to be
     called directly.
     """
+    global is_leader  # pylint: disable=global-statement
+
+    with scheduler.app.app_context():
+        try:
+            leader = leader_lease is None or leader_lease.acquire()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error renewing the scheduler lease: %s", exc, exc_info=True)
+            leader = False
+
+        if leader != is_leader:
+            logger.info("%s the scheduler leader", "Became" if leader else "No longer")
+            is_leader = leader
+            if leader:
+                _run_migrations()
+                _rebuild_closing_queue()
+
+
+def release_leadership():
+    """
+    Stop the jobs and give up the leader lease, so that another process takes
+    over without waiting for the lease to expire.
+
+    Registered to run when the process exits.
+    """
+    global is_leader  # pylint: disable=global-statement
+
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+    if not is_leader:
+        return
+    is_leader = False
+
+    if leader_lease is not None:
+        try:
+            leader_lease.release()
+            logger.info("Released the scheduler lease")
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error releasing the scheduler lease: %s", exc, exc_info=True)
+
+
+@leader_only
+def _handle_item_closing(item_id):
+    """
+    Handle the closing of an item.
+
+    This function is meant to be run by the closing engine, and is not meant to
+    be called directly.
+    """
 
     with scheduler.app.app_context():
-        item = Item.objects.get(id=item_id)
+        item = Item.objects(id=item_id).first()
+        if item is None:
+            # Deleted in another process.
+            return
+
         handle_item_closing(item)
 
+        # The closing time was extended in another process.
+        if item.is_open:
+            closing_engine.schedule(item.id, item.closes_at)
+
+
+closing_engine = ClosingEngine(_handle_item_closing)
+"Closes items when their auction ends."
+
+
+def update_closing_queue(item_id, closes_at: Optional[datetime]):
+    """
+    Schedule the item to be closed at `closes_at`, or stop tracking it if None.
+
+    Other processes than the leader would never close the item, so they publish
+    the closing time to the leader on :data:`CLOSING_CHANNEL` instead, or leave
+    it for the leader to find in the database.
+    """
+    if not is_leader:
+        if closing_broadcaster is None:
+            return
+        try:
+            closing_broadcaster.publish(CLOSING_CHANNEL, 'closing', {
+                'id': str(item_id),
+                'closes_at': closes_at.isoformat() if closes_at else None,
+            })
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Error publishing the closing time of item %s: %s", item_id, exc, exc_info=True)
+    elif closes_at is None:
+        closing_engine.cancel(item_id)
+    else:
+        logger.debug('Scheduling item %s to close at %s', item_id, closes_at)
+        closing_engine.schedule(item_id, closes_at)
+
+
+def _follow_closing_events(subscription: Subscription):
+    """
+    Schedule the items saved in other processes, while the leader.
+
+    This function is meant to be run in a thread of its own.
+    """
+    while True:
+        if (message := subscription.get()) is None:
+            continue
+
+        _, data = message
+        if is_leader:
+            closes_at = datetime.fromisoformat(data['closes_at']) if data['closes_at'] else None
+            update_closing_queue(ObjectId(data['id']), closes_at)
+
 
-# Even as this is named function, it's used as a closure, so it can access
-# the scheduler variable.
 def _schedule_item_closing_task(sender, document, **kwargs):  # pylint: disable=unused-argument
     """
-    Schedule a task to close the item when the auction ends.
+    Schedule the item to be closed when the auction ends.
 
     This function is meant to be connected to the post_save signal of the Item
-    model.
+    model. Saving an item again replaces its closing time.
     """
 
-    if not document.closes_at:
-        # The item does not have an auction end time, so there is no need to
-        # schedule a task to close it.
-        logger.debug("Not scheduling closing, as item %s does not have an auction end time", document.id)
+    if not document.closes_at or document.closed:
+        # The item is already closed, or does not have an auction end time, so
+        # there is no need to close it.
+        update_closing_queue(document.id, None)
         return
 
-    if document.closed:
-        # The item is already closed, so there is no need to schedule a task to
-        # close it.
-        return
+    update_closing_queue(document.id, document.closes_at)
+
+
+def _cancel_item_closing_task(sender, document, **kwargs):  # pylint: disable=unused-argument
+    """
+    Stop tracking the closing of a deleted item.
+
+    This function is meant to be connected to the post_delete signal of the
+    Item model.
+    """
+    update_closing_queue(document.id, None)
+
+
+def _load_closing_queue(closes_before=None):
+    """
+    Schedule the open items from the database, using the `closes_at` index.
+
+    :param closes_before: Only load items closing before this time.
+    """
+    items = Item.objects(closed__ne=True, closes_at__ne=None)
+    if closes_before is not None:
+        items = items.filter(closes_at__lt=closes_before)
+
+    items = items.only('closes_at').order_by('closes_at').as_pymongo()
+    closing_engine.load((item['_id'], item['closes_at']) for item in items)
+    logger.debug("Closing queue has %d items", len(closing_engine))
+
+
+@leader_only
+def _run_migrations():
+    """
+    Backfill the prices of items bid on before they were maintained, once per
+    database. The migrations done are recorded in :data:`MIGRATIONS_COLLECTION`.
+
+    This function is meant to be run by the APScheduler, and is not meant to be
+    called directly.
+    """
+    with scheduler.app.app_context():
+        migrations = get_db()[MIGRATIONS_COLLECTION]
+        if migrations.find_one({'_id': 'backfill-prices'}) is not None:
+            return
+
+        try:
+            count = backfill_item_prices()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Error backfilling item prices: %s", exc, exc_info=True)
+            return
+
+        migrations.update_one({'_id': 'backfill-prices'},
+                              {'$set': {'done_at': datetime.utcnow(), 'items': count}}, upsert=True)
+        logger.info("Backfilled the prices of %d items", count)
+
+
+@leader_only
+def _rebuild_closing_queue():
+    """
+    Schedule all the open items, after a restart.
+
+    This function is meant to be run by the APScheduler, and is not meant to be
+    called directly.
+    """
+    with scheduler.app.app_context():
+        _load_closing_queue()
+
 
-    logger.debug('Scheduling task to close item %s', document.id)
-    scheduler.add_job(
-        func=_handle_item_closing,
-        args=(document.id,),
-        trigger='date',
-        run_date=document.closes_at + timedelta(seconds=1),
-        id=f'close-item-{document.id}',
-    )
+@leader_only
+def _refresh_closing_queue():
+    """
+    Schedule the items closing soon, that were saved in other processes.
 
+    This function is meant to be run by the APScheduler, and is not meant to be
+    called directly.
+    """
+    with scheduler.app.app_context():
+        _load_closing_queue(datetime.utcnow() + CLOSING_QUEUE_HORIZON)
+
+
+@leader_only
 def _close_items():
     """
     Close expired bids.
@@ -106,28 +378,19 @@ def _close_items():
     This function is meant to be run by the APScheduler, and is not meant to be
     called directly.
     """
-    with scheduler.app.app_context():
+    with scheduler.app.app_context(), JOB_DURATION.time(job='close-items'):
         logger.info("Running scheduled task 'close-items'")
 
-        # Get items that are past the closing date, and are not already closed
+        # Close items that are past the closing date, and are not already closed
         closes_before = datetime.utcnow() + timedelta(seconds=2)
-        items = Item.objects(Q(closed=None) | Q(closed=False), closes_at__lt=closes_before).all()
-        logger.debug("Closing %d items", len(items))
-
-        # Close each item
-        for item in items:
-            try:
-                # Make sure item is not already closed
-                if item.closed:
-                    continue
-
-                handle_item_closing(item)
-
-            except Exception as exc:
-                logger.error("Error closing items: %s", exc, exc_info=True, extra={
-                    'item_id': item.id,
-                })
-                
+        try:
+            count = close_expired_items(closes_before)
+            logger.debug("Closed %d items", count)
+        except Exception as exc:
+            logger.error("Error closing items: %s", exc, exc_info=True)
+
+
+@leader_only
 def _update_currency_rates():
     """
     Update the currency rates from the European Central Bank.
@@ -136,6 +399,6 @@ def _update_currency_rates():
     called directly.
     """
     from .currency import fetch_currency_file
-    with scheduler.app.app_context():
+    with scheduler.app.app_context(), JOB_DURATION.time(job='update-currency-rates'):
         logger.debug("Running scheduled task 'update-currency-rates'")
         fetch_currency_file()
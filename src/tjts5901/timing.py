@@ -0,0 +1,179 @@
+"""
+Server timing
+=============
+
+Opt-in breakdown of where the time of a request goes, sent in the
+`Server-Timing` response header that browser developer tools show::
+
+    Server-Timing: db;dur=12.1;desc="3 commands", template;dur=30.5;desc="1 render",
+        currency;dur=4.2;desc="2 calls", locale;dur=0.1;desc="1 call", total;dur=51.0
+
+The phases are MongoDB commands, template rendering, currency formatting and
+locale resolution. They overlap: the queries and formatting done while
+rendering are also part of the template time.
+
+Enable with `SERVER_TIMING`. A `SERVER_TIMING_LOG_SAMPLE_RATE` share of the
+requests slower than `SERVER_TIMING_SLOW_THRESHOLD` seconds is also logged,
+with the breakdown in the `timings` field of the record.
+"""
+
+from contextlib import contextmanager
+import functools
+import logging
+from random import random
+from time import perf_counter
+
+from flask import Flask, Response, before_render_template, current_app, g, has_app_context, request, template_rendered
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+UNITS = {
+    'db': "command",
+    'template': "render",
+    'currency': "call",
+    'locale': "call",
+}
+"Phases of a request, and what their count is of."
+
+
+def record_timing(phase: str, seconds: float):
+    """
+    Add time spent in a phase to the timings of the current request, if timed.
+    """
+    if has_app_context() and (timings := g.get('server_timing')) is not None:
+        entry = timings.setdefault(phase, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def measure(phase: str):
+    """
+    Record the time spent in the with block as a phase of the request.
+    """
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(phase, perf_counter() - started)
+
+
+def measured(phase: str):
+    """
+    Decorate a function to record the time spent in it as a phase of the request.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Records the time of MongoDB commands for the request that sent them.
+
+    Commands are monitored in the thread that sends them, so the current
+    request is the one that sent the command.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_timing('db', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_timing('db', event.duration_micros / 1e6)
+
+
+_command_timer_registered = False
+
+
+def init_server_timing(app: Flask):
+    """
+    Time the phases of requests, if enabled with `SERVER_TIMING`.
+
+    Meant to be called before the database is connected, so that the command
+    listener applies to the connection.
+    """
+    global _command_timer_registered  # pylint: disable=global-statement
+
+    app.config.setdefault('SERVER_TIMING', False)
+    "Whether to send the Server-Timing header."
+
+    app.config.setdefault('SERVER_TIMING_SLOW_THRESHOLD', 1.0)
+    "Seconds after which a request is logged as slow."
+
+    app.config.setdefault('SERVER_TIMING_LOG_SAMPLE_RATE', 0.1)
+    "Share of the slow requests that are logged."
+
+    if not app.config['SERVER_TIMING']:
+        return
+
+    if not _command_timer_registered:
+        monitoring.register(CommandTimer())
+        _command_timer_registered = True
+
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+    app.before_request(_start_timing)
+    app.after_request(_finish_timing)
+
+
+def _start_timing():
+    g.server_timing = {}
+    g.server_timing_started = perf_counter()
+    g.server_timing_templates = []
+
+
+def _template_started(sender, template, context, **extra):  # pylint: disable=unused-argument
+    if (templates := g.get('server_timing_templates')) is not None:
+        templates.append(perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):  # pylint: disable=unused-argument
+    if templates := g.get('server_timing_templates'):
+        record_timing('template', perf_counter() - templates.pop())
+
+
+def format_server_timing(timings: dict, total: float) -> str:
+    """
+    Format the phase timings and the total time of a request as a Server-Timing header.
+
+    :param timings: Seconds spent and number of times, by phase.
+    :param total: Seconds spent on the request.
+    """
+    entries = [
+        f'{phase};dur={seconds * 1000:.1f};desc="{count} {UNITS.get(phase, "time")}{"" if count == 1 else "s"}"'
+        for phase, (seconds, count) in timings.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def _finish_timing(response: Response) -> Response:
+    if (timings := g.pop('server_timing', None)) is None:
+        return response
+
+    total = perf_counter() - g.pop('server_timing_started')
+    g.pop('server_timing_templates', None)
+    response.headers['Server-Timing'] = format_server_timing(timings, total)
+
+    if total >= current_app.config['SERVER_TIMING_SLOW_THRESHOLD'] \
+            and random() < current_app.config['SERVER_TIMING_LOG_SAMPLE_RATE']:
+        logger.warning("Slow request to %s took %.0f ms", request.endpoint, total * 1000, extra={
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 1),
+            'timings': {phase: {'duration_ms': round(seconds * 1000, 1), 'count': count}
+                        for phase, (seconds, count) in timings.items()},
+        })
+
+    return response
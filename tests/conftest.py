@@ -1,7 +1,40 @@
+from contextlib import contextmanager
 from os import environ
 import pytest
+from mongoengine import disconnect
+from pymongo import MongoClient, monitoring
+from pymongo.errors import ServerSelectionTimeoutError
 from tjts5901 import create_app
 
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Records the MongoDB commands sent by the application.
+
+    Registered globally, so it sees the commands of every client created after
+    this module is imported.
+    """
+
+    IGNORED_COMMANDS = {"ping", "endSessions", "createIndexes", "listIndexes", "dropDatabase"}
+    "Housekeeping commands that are not counted as queries."
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name not in self.IGNORED_COMMANDS:
+            self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
 def pytest_addoption(parser: pytest.Parser):
     """
     Callback to add command-line options for pytest.
@@ -39,3 +72,96 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture(scope="session")
+def mongo_url():
+    """
+    Address of the MongoDB server used for tests.
+
+    Define it in environment variable `TEST_MONGO_URL`, defaults to local server::
+        $ TEST_MONGO_URL="mongodb://localhost:27017/tjts5901-test" pytest
+
+    Tests depending on this fixture are skipped if the server is not reachable.
+    """
+    url = environ.get("TEST_MONGO_URL", "mongodb://localhost:27017/tjts5901-test")
+
+    client = MongoClient(url, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        pytest.skip(f"MongoDB is not reachable at {url}")
+    finally:
+        client.close()
+
+    return url
+
+
+@pytest.fixture
+def db_app(mongo_url):
+    """
+    Flask app connected to a disposable test database.
+
+    The test runs inside a request context, so helpers that depend on the locale
+    can be called directly. The database is dropped after the test.
+    """
+    from tjts5901.db import db  # pylint: disable=import-outside-toplevel
+    from tjts5901.scheduler import closing_engine, scheduler  # pylint: disable=import-outside-toplevel
+
+    # The app module connects and starts the scheduler on import, so the default
+    # connection has to be replaced, and the background jobs kept from closing
+    # the test's items.
+    if scheduler.running:
+        scheduler.pause()
+    closing_engine.stop()
+    disconnect()
+    flask_app = create_app({
+        'TESTING': True,
+        'MONGODB_SETTINGS': {
+            'host': mongo_url,
+        },
+    })
+
+    with flask_app.test_request_context():
+        yield flask_app
+
+        db.connection.drop_database(db.get_db().name)
+
+    disconnect()
+
+
+@pytest.fixture
+def mongo_commands(db_app):
+    """
+    List of MongoDB command names sent during the test.
+
+    Clear it before the part of the test being measured.
+    """
+    command_counter.commands = []
+    return command_counter.commands
+
+
+@pytest.fixture
+def query_budget(db_app, mongo_commands):
+    """
+    Context manager failing the test if its block sends more MongoDB commands
+    than the budget.
+
+    The block runs in a new application context, so requests in it don't
+    reuse the identity map or the logged in user of the test's context. The
+    commands sent are collected into the list it returns::
+
+        with query_budget(3) as commands:
+            client.get("/")
+    """
+    @contextmanager
+    def budget(max_commands: int):
+        start = len(mongo_commands)
+        commands = []
+        with db_app.app_context():
+            yield commands
+        commands.extend(mongo_commands[start:])
+        assert len(commands) <= max_commands, \
+            f"{len(commands)} MongoDB commands, over the budget of {max_commands}: {commands}"
+
+    return budget
@@ -0,0 +1,84 @@
+"""
+Admission control tests
+=======================
+"""
+
+from tjts5901 import create_app
+from tjts5901.admission import AdmissionController, ConcurrencyLimiter
+
+
+def test_concurrency_limiter():
+    """
+    The limit shrinks while requests are slow, and grows back when they are fast.
+    """
+    limiter = ConcurrencyLimiter(4, target_latency=0.1)
+    assert all(limiter.acquire() for _ in range(4))
+    assert not limiter.acquire()
+
+    for _ in range(4):
+        limiter.release(latency=1)
+    assert limiter.limit < 3
+
+    # No more than the lowered limit at once.
+    assert all(limiter.acquire() for _ in range(int(limiter.limit)))
+    assert not limiter.acquire()
+    for _ in range(int(limiter.limit)):
+        limiter.release()
+
+    for _ in range(100):
+        assert limiter.acquire()
+        limiter.release(latency=0.01)
+    assert limiter.limit == 4
+
+
+def test_admission_controller():
+    """
+    Writes can not take the capacity reserved for reads.
+    """
+    admission = AdmissionController(capacity=4, reserved_share=0.5)
+
+    assert admission.admit(write=True) is None
+    assert admission.admit(write=True) is None
+    assert admission.admit(write=True) == 429
+
+    assert admission.admit(write=False) is None
+    assert admission.admit(write=False) is None
+    assert admission.admit(write=False) == 503
+
+    admission.release(write=True)
+    assert admission.admit(write=False) is None
+
+
+def test_load_shedding():
+    """
+    Busy servers reject requests early, except for exempt endpoints.
+    """
+    app = create_app({
+        'TESTING': True,
+        'ADMISSION_CONTROL': True,
+        'ADMISSION_CAPACITY': 2,
+        'ADMISSION_RESERVED_SHARE': 0.5,
+        'ADMISSION_QUEUE_TIMEOUT': 0,
+    })
+    admission: AdmissionController = app.extensions['admission']
+    client = app.test_client()
+
+    # A bid storm is using all of the write capacity.
+    assert admission.admit(write=True) is None
+    response = client.post("/auth/login", data={"email": "user@example.com", "password": "x"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+    # Reads use the reserved capacity.
+    assert client.get("/auth/login").status_code == 200
+
+    assert admission.admit(write=False) is None
+    assert client.get("/auth/login").status_code == 503
+    assert client.get("/hello").status_code == 200
+
+    # Slots of finished requests are given back.
+    admission.release(write=False)
+    admission.release(write=True)
+    assert admission.total.in_flight == 0
+    assert client.get("/auth/login").status_code == 200
+    assert admission.total.in_flight == 0
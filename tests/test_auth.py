@@ -0,0 +1,231 @@
+"""
+Authentication tests
+====================
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import os
+import threading
+from time import perf_counter
+
+from flask import request
+import pytest
+from werkzeug.security import generate_password_hash
+
+from tjts5901.auth import LRUCache, TokenCache, load_logged_in_user, load_user_from_request
+from tjts5901.models import AccessToken, User
+from tjts5901.notification import send_notification
+from tjts5901.passwords import PasswordHasher, PasswordHasherBusy
+
+
+def authenticate(app, token):
+    """
+    Load the user for a request carrying the token.
+    """
+    with app.test_request_context(headers={'Authorization': f"Bearer {token}"}):
+        return load_user_from_request(request)
+
+
+def test_token_cache(db_app, mongo_commands):
+    """
+    Tokens are checked from the cache, and their last use is written in bulk.
+    """
+    user = User(email="user@example.com", password="x").save()
+    token = AccessToken(name="API", user=user).save()
+    token_cache: TokenCache = db_app.extensions['token_cache']
+    mongo_commands.clear()
+
+    assert authenticate(db_app, token.token) == user
+    # The token and the user.
+    assert mongo_commands == ['find', 'find']
+
+    mongo_commands.clear()
+    for _ in range(10):
+        assert authenticate(db_app, token.token) == user
+    # The user is kept in the identity map of the test's app context.
+    assert not mongo_commands
+
+    assert token.reload().last_used_at is None
+    token_cache.flush()
+    assert token.reload().last_used_at is not None
+
+    assert authenticate(db_app, "unknown") is None
+
+
+def test_token_cache_invalidation(db_app):
+    """
+    Expired and deleted tokens stop working right away.
+    """
+    user = User(email="user@example.com", password="x").save()
+    token = AccessToken(name="API", user=user).save()
+    assert authenticate(db_app, token.token) == user
+
+    token.expires = datetime.utcnow() - timedelta(minutes=1)
+    token.save()
+    assert authenticate(db_app, token.token) is None
+
+    token.expires = None
+    token.save()
+    assert authenticate(db_app, token.token) == user
+
+    token.delete()
+    assert authenticate(db_app, token.token) is None
+
+
+def test_lru_cache():
+    """
+    The least recently used tokens are evicted, and old entries expire.
+    """
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    cache.ttl = -1
+    assert cache.get("a") is None
+
+
+def load_user(app, user_id):
+    """
+    Load the logged in user, as at the start of a new request.
+    """
+    with app.app_context():
+        return load_logged_in_user(user_id)
+
+
+def test_user_cache(db_app, mongo_commands):
+    """
+    Logged in users are loaded from the cache until they change.
+    """
+    user = User(email="user@example.com", password="x", unread_notifications=0).save()
+    mongo_commands.clear()
+
+    assert load_user(db_app, str(user.id)) == user
+    assert mongo_commands == ['find']
+
+    mongo_commands.clear()
+    for _ in range(10):
+        cached = load_user(db_app, str(user.id))
+    assert not mongo_commands
+    assert cached.email == user.email
+    assert cached is not load_user(db_app, str(user.id))
+
+    # Disabling the user takes effect on the next request.
+    user.is_disabled = True
+    user.save()
+    assert not load_user(db_app, str(user.id)).is_active
+
+    # So does counting a new notification, which updates the user in place.
+    send_notification(user, "Hello")
+    assert load_user(db_app, str(user.id)).unread_notifications == 1
+
+    user.delete()
+    assert load_user(db_app, str(user.id)) is None
+
+
+def test_user_cache_benchmark(db_app, requests=200):
+    """
+    Compare authenticated page loads with and without the user cache.
+
+    Run with `pytest -s` to see the results.
+    """
+    user = User(email="user@example.com", password="x").save()
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+        session['locale'] = 'en_GB'
+
+    def run():
+        # Each request in its own app context, like in a server.
+        for _ in range(requests):
+            assert client.get("/sell").status_code == 200
+
+    def requests_per_second(cache_size):
+        db_app.extensions['user_cache'] = LRUCache(maxsize=cache_size, ttl=60)
+        thread = threading.Thread(target=run)
+        started = perf_counter()
+        thread.start()
+        thread.join()
+        return requests / (perf_counter() - started)
+
+    requests_per_second(1)  # Warm up
+    uncached = requests_per_second(0)
+    cached = requests_per_second(1024)
+
+    print(f"\n{requests} requests to /sell: uncached {uncached:.0f}/s, "
+          f"cached {cached:.0f}/s ({cached / uncached:.2f}x)")
+
+
+def test_password_hasher():
+    """
+    Passwords are hashed with the configured cost, at most `workers` at a time.
+    """
+    hasher = PasswordHasher("pbkdf2:sha256:1000", workers=1, queue_timeout=0)
+    pwhash = hasher.hash("secret")
+
+    assert pwhash.startswith("pbkdf2:sha256:1000$")
+    assert hasher.check(pwhash, "secret")
+    assert not hasher.check(pwhash, "wrong")
+
+    assert not hasher.needs_rehash(pwhash)
+    assert hasher.needs_rehash(generate_password_hash("secret", "pbkdf2:sha256:500"))
+
+    # No free slot.
+    with hasher._slots:  # pylint: disable=protected-access
+        with pytest.raises(PasswordHasherBusy):
+            hasher.check(pwhash, "secret")
+
+
+def test_register_busy(app):
+    """
+    Registrations are turned away when no hashing slot frees up.
+    """
+    hasher = app.extensions['password_hasher'] = PasswordHasher("pbkdf2:sha256:1000", workers=1, queue_timeout=0)
+
+    with hasher._slots:  # pylint: disable=protected-access
+        response = app.test_client().post("/auth/register", data={"email": "user@example.com", "password": "secret"})
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    assert "The server is busy" in response.get_data(as_text=True)
+
+
+def test_login_rehash(db_app):
+    """
+    Passwords hashed with an old cost are rehashed on login.
+    """
+    old_hash = generate_password_hash("secret", "pbkdf2:sha256:1000")
+    user = User(email="user@example.com", password=old_hash).save()
+
+    client = db_app.test_client()
+    response = client.post("/auth/login", data={"email": user.email, "password": "secret"})
+    assert response.status_code == 302
+
+    new_hash = user.reload().password
+    assert new_hash.startswith(db_app.config['PASSWORD_HASH_METHOD'] + "$")
+    assert client.post("/auth/login", data={"email": user.email, "password": "secret"}).status_code == 302
+
+
+def test_password_hasher_benchmark(logins=16):
+    """
+    Measure password checks per second and core, with the default cost.
+
+    Run with `pytest -s` to see the results.
+    """
+    cores = os.cpu_count() or 1
+    hasher = PasswordHasher("pbkdf2:sha256:260000", workers=cores)
+    pwhash = hasher.hash("secret")
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=cores * 4) as executor:
+        assert all(executor.map(lambda _: hasher.check(pwhash, "secret"), range(logins)))
+    elapsed = perf_counter() - started
+
+    print(f"\n{logins} logins on {cores} cores: {logins / elapsed / cores:.1f} logins/s per core")
@@ -0,0 +1,355 @@
+"""
+Bidding tests
+=============
+
+Tests for placing bids. These need a MongoDB server, see the `db_app` fixture
+in conftest.py.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from random import randint, shuffle
+from time import perf_counter
+
+from flask import g
+from mongoengine import QuerySet
+from pymongo.errors import AutoReconnect, OperationFailure
+import pytest
+
+from tjts5901.db import get_identity_map
+from tjts5901.items import BID_SAVE_RETRIES, MIN_BID_INCREMENT, get_item_price, place_bid, place_bids
+from tjts5901.models import Bid, Item, User
+from tjts5901.notification import send_notification
+
+
+@pytest.fixture
+def item(db_app):
+    """
+    An open item with a starting bid of 10.
+    """
+    seller = User(email="seller@example.com", password="x").save()
+    return Item(
+        title="Contested item",
+        description="Everyone wants this.",
+        starting_bid=10,
+        seller=seller,
+        closes_at=datetime.utcnow() + timedelta(hours=1),
+    ).save()
+
+
+def test_place_bid(item):
+    """
+    Bids must beat the current price, and rejected bids report the new minimum.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+
+    assert not place_bid(item, bidder, 10).success
+
+    result = place_bid(item, bidder, 20)
+    assert result.success
+    assert get_item_price(Item.objects.get(id=item.id)) == 20
+
+    # The stale item document still thinks the price is 10.
+    stale = Item.objects.get(id=item.id)
+    stale.current_price = None
+    result = place_bid(stale, bidder, 15)
+    assert not result.success
+    assert result.min_amount == 20 + MIN_BID_INCREMENT
+    assert Bid.objects(item=item).count() == 1
+
+
+def test_place_bid_save_fails(item, monkeypatch):
+    """
+    A bid that can't be stored leaves the item as it was.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    assert place_bid(item, bidder, 20).success
+
+    def fail(*args, **kwargs):
+        raise OperationFailure("insert failed")
+
+    monkeypatch.setattr(Bid, "save", fail)
+    result = place_bid(item, bidder, 30)
+    assert not result.success
+
+    item = Item.objects.get(id=item.id)
+    assert item.current_price == 20
+    assert item.bid_count == 1
+    assert item.leading_bid.amount == 20
+    assert Bid.objects(item=item).count() == 1
+
+
+def test_place_bids(item, mongo_commands):
+    """
+    Batch of bids is validated and placed with a constant number of queries.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    other = Item(title="Other item", description="", starting_bid=100,
+                 seller=item.seller, closes_at=item.closes_at).save()
+    mongo_commands.clear()
+
+    results = place_bids(bidder, [
+        (str(item.id), 20),
+        (str(other.id), 50),
+        ("not an id", 50),
+        (str(item.id), 30),
+        (str(other.id), 150),
+    ])
+
+    assert [result.success for result in results] == [False, False, False, True, True]
+    assert results[0].min_amount == 31
+    assert results[1].min_amount == 101
+
+    # Load items, insert bids, and update the price of each item.
+    assert len(mongo_commands) == 4, mongo_commands
+
+    assert get_item_price(Item.objects.get(id=item.id)) == 30
+    assert get_item_price(Item.objects.get(id=other.id)) == 150
+    assert sorted(bid.amount for bid in Bid.objects(bidder=bidder)) == [30, 150]
+
+
+def test_place_bids_outbid_after_update(item, monkeypatch):
+    """
+    A batch bid that is outbid right after its update was accepted stays accepted.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    other = User(email="other@example.com", password="x").save()
+    collection = type(Item._get_collection())  # pylint: disable=protected-access
+    find_one_and_update = collection.find_one_and_update
+
+    def overtaken(self, *args, **kwargs):
+        updated = find_one_and_update(self, *args, **kwargs)
+        assert place_bid(Item.objects.get(id=item.id), other, 50).success
+        return updated
+
+    monkeypatch.setattr(collection, "find_one_and_update", overtaken)
+    result, = place_bids(bidder, [(str(item.id), 20)])
+    assert result.success
+
+    item = Item.objects.get(id=item.id)
+    assert item.current_price == 50
+    assert item.bid_count == 2
+    assert sorted(bid.amount for bid in Bid.objects(item=item)) == [20, 50]
+
+
+def test_place_bid_save_retried(item, monkeypatch):
+    """
+    An insert that was stored but reported a connection error is not stored twice.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    save = Bid.save
+    calls = []
+
+    def flaky_save(self, *args, **kwargs):
+        calls.append(self.id)
+        save(self, *args, **kwargs)
+        if len(calls) == 1:
+            raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(Bid, "save", flaky_save)
+    result = place_bid(item, bidder, 20)
+    assert result.success
+    assert len(calls) == 2
+
+    item = Item.objects.get(id=item.id)
+    assert item.leading_bid.id == result.bid.id
+    assert Bid.objects(item=item).count() == 1
+
+
+def test_place_bid_save_gives_up(item, monkeypatch):
+    """
+    A bid that could not be saved is not left behind, even if an attempt stored it.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    save = Bid.save
+    calls = []
+
+    def failing_save(self, *args, **kwargs):
+        calls.append(self.id)
+        if len(calls) == 1:
+            # Stored, but the acknowledgement was lost.
+            save(self, *args, **kwargs)
+        raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(Bid, "save", failing_save)
+    assert not place_bid(item, bidder, 20).success
+    assert len(calls) == BID_SAVE_RETRIES
+
+    item = Item.objects.get(id=item.id)
+    assert item.leading_bid is None
+    assert item.bid_count == 0
+    assert Bid.objects(item=item).count() == 0
+
+
+def test_place_bids_insert_fails(item, monkeypatch):
+    """
+    Bids that can't be stored leave the items as they were.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    assert place_bid(item, bidder, 20).success
+
+    def fail(*args, **kwargs):
+        raise OperationFailure("insert failed")
+
+    monkeypatch.setattr(QuerySet, "insert", fail)
+    results = place_bids(bidder, [(str(item.id), 30)])
+    assert not results[0].success
+
+    item = Item.objects.get(id=item.id)
+    assert item.current_price == 20
+    assert item.bid_count == 1
+    assert item.leading_bid.amount == 20
+    assert Bid.objects(item=item).count() == 1
+
+
+def test_place_bid_contention(db_app, item, bids=2000, workers=32):
+    """
+    Fire concurrent bids at a single item, and check that the highest bid wins
+    and no outbid bid is stored.
+
+    Reports throughput and latency; run with `pytest -s` to see them.
+    """
+    bidders = [User(email=f"bidder{i}@example.com", password="x").save() for i in range(workers)]
+    amounts = list(range(item.starting_bid + 1, item.starting_bid + 1 + bids))
+    shuffle(amounts)
+
+    def bid(amount):
+        with db_app.test_request_context():
+            started = perf_counter()
+            result = place_bid(Item.objects.get(id=item.id), bidders[randint(0, workers - 1)], amount)
+            return result, perf_counter() - started
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(bid, amounts))
+    elapsed = perf_counter() - started
+
+    latencies = sorted(latency for _, latency in results)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"\n{bids} bids in {elapsed:.2f}s: {bids / elapsed:.0f} bids/s, p99 latency {p99 * 1000:.1f} ms")
+
+    accepted = [result.bid.amount for result, _ in results if result.success]
+    item.reload()
+    assert item.current_price == max(amounts)
+    assert item.leading_bid.amount == max(amounts)
+
+    # Every stored bid was the leading bid when it was accepted.
+    stored = sorted(bid.amount for bid in Bid.objects(item=item))
+    assert stored == sorted(accepted)
+    assert len(set(stored)) == len(stored)
+
+
+def test_api_item_bids(db_app, item):
+    """
+    Bid history is returned as bid objects, highest first, one page at a time.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    for amount in (20, 30, 40, 50, 60):
+        assert place_bid(item, bidder, amount).success
+
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(bidder.id)
+        session['_fresh'] = True
+
+    amounts = []
+    url = f"/api/items/{item.id}/bids?limit=2"
+    while url:
+        data = client.get(url).get_json()
+        assert data['success']
+        assert all(bid['item'] == str(item.id) for bid in data['bids'])
+        amounts.append([bid['amount'] for bid in data['bids']])
+        url = data['next_cursor'] and f"/api/items/{item.id}/bids?limit=2&after={data['next_cursor']}"
+
+    assert amounts == [[60, 50], [40, 30], [20]]
+
+    assert client.get(f"/api/items/{item.id}/bids?after=bogus").status_code == 400
+    assert client.get(f"/api/items/{item.id}/bids?limit=0").status_code == 400
+
+
+def test_item_etag(db_app, item, mongo_commands):
+    """
+    Unchanged item pages are answered with 304 from one item lookup, until a bid is placed.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(bidder.id)
+        session['_fresh'] = True
+        session['locale'] = 'en_GB'
+
+    for url in (f"/item/{item.id}", f"/api/items/{item.id}/bids"):
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        # The item is loaded again, like in a new request. The user stays in
+        # the test's app context.
+        get_identity_map().clear()
+        mongo_commands.clear()
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert mongo_commands == ['find'], mongo_commands
+
+        assert place_bid(item, bidder, get_item_price(item) + MIN_BID_INCREMENT).success
+        get_identity_map().clear()
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+
+def test_item_etag_notifications(db_app, item):
+    """
+    Item pages are not answered with 304 when the user has new notifications to show.
+    """
+    bidder = User(email="bidder@example.com", password="x").save()
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(bidder.id)
+        session['_fresh'] = True
+        session['locale'] = 'en_GB'
+
+    url = f"/item/{item.id}"
+    assert client.get(url).status_code == 200
+    etag = client.get(url).headers['ETag']
+
+    send_notification(bidder, "You have been outbid")
+    # Load the user again, like in a new request.
+    g.pop('_login_user', None)
+    get_identity_map().clear()
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert "You have been outbid" in response.get_data(as_text=True)
+
+
+def test_backfill_item_prices(db_app):
+    """
+    Items bid on before prices were maintained get their leading bid, price and bid count.
+    """
+    seller = User(email="seller@example.com", password="x").save()
+    bidder = User(email="bidder@example.com", password="x").save()
+    closes_at = datetime.utcnow() + timedelta(hours=1)
+    old, empty, current = [
+        Item(title=title, description="", starting_bid=1, seller=seller, closes_at=closes_at).save()
+        for title in ("Old", "Empty", "Current")
+    ]
+    for amount in (5, 7, 6):
+        Bid(item=old, bidder=bidder, amount=amount).save()
+    # Bids after the closing time don't count.
+    Bid(item=old, bidder=bidder, amount=100, created_at=closes_at + timedelta(seconds=1)).save()
+    assert place_bid(current, bidder, 20).success
+
+    result = db_app.test_cli_runner().invoke(args=["items", "backfill-prices"])
+    assert "1 items updated" in result.output
+
+    old.reload()
+    assert old.leading_bid.amount == 7
+    assert old.current_price == 7
+    assert old.bid_count == 3
+    assert get_item_price(old) == 7
+    assert empty.reload().leading_bid is None
+    assert current.reload().current_price == 20
+    assert current.bid_count == 1
+
+    # Bids below the real high bid are no longer accepted.
+    assert not place_bid(old, bidder, 7).success
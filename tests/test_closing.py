@@ -0,0 +1,199 @@
+"""
+Closing engine tests
+====================
+"""
+
+from datetime import datetime, timedelta
+import threading
+from time import perf_counter
+
+from tjts5901.closing import ClosingEngine
+from tjts5901.items import close_expired_items, close_items, handle_item_closing
+from tjts5901.models import Bid, Item, Notification, User
+
+
+def test_pop_due():
+    """
+    Items come due in deadline order, and rescheduled or cancelled items only once or never.
+    """
+    engine = ClosingEngine(lambda item_id: None)
+    now = datetime.utcnow()
+
+    engine.load([("a", now + timedelta(seconds=3)), ("b", now + timedelta(seconds=1))])
+    engine.schedule("c", now + timedelta(seconds=2))
+    engine.schedule("c", now + timedelta(seconds=2))
+    engine.schedule("d", now + timedelta(seconds=1))
+    engine.schedule("d", now + timedelta(seconds=5))
+    engine.schedule("e", now + timedelta(seconds=1))
+    engine.cancel("e")
+    engine.cancel("unknown")
+    assert len(engine) == 4
+
+    assert engine.pop_due(now) == []
+    assert engine.pop_due(now + timedelta(seconds=2)) == ["b", "c"]
+    assert engine.pop_due(now + timedelta(seconds=4)) == ["a"]
+    assert engine.pop_due(now + timedelta(seconds=10)) == ["d"]
+    assert len(engine) == 0
+
+
+def test_compaction():
+    """
+    Stale entries of rescheduled items don't accumulate.
+    """
+    engine = ClosingEngine(lambda item_id: None)
+    now = datetime.utcnow()
+    for i in range(1000):
+        engine.schedule("a", now + timedelta(seconds=i))
+
+    assert len(engine._heap) < 100  # pylint: disable=protected-access
+    assert engine.pop_due(now + timedelta(seconds=1000)) == ["a"]
+
+
+def test_closing_thread():
+    """
+    The thread closes items shortly after their deadline, waking up for new earlier deadlines.
+    """
+    closed = []
+    done = threading.Event()
+
+    def close(item_id):
+        closed.append((item_id, perf_counter()))
+        if len(closed) == 2:
+            done.set()
+
+    engine = ClosingEngine(close)
+    engine.start()
+    try:
+        started = perf_counter()
+        engine.schedule("late", datetime.utcnow() + timedelta(hours=1))
+        engine.schedule("b", datetime.utcnow() + timedelta(milliseconds=200))
+        engine.schedule("a", datetime.utcnow() + timedelta(milliseconds=100))
+        assert done.wait(timeout=5)
+    finally:
+        engine.stop()
+
+    assert [item_id for item_id, _ in closed] == ["a", "b"]
+    assert closed[-1][1] - started < 1
+    assert len(engine) == 1
+
+
+def test_close_expired_items(db_app, mongo_commands):
+    """
+    Expired items are closed with their winners, using a constant number of queries.
+    """
+    now = datetime.utcnow()
+    seller = User(email="seller@example.com", password="x").save()
+    bidder = User(email="bidder@example.com", password="x").save()
+    late = User(email="late@example.com", password="x").save()
+
+    items = []
+    for i in range(10):
+        item = Item(title=f"Item {i}", description="", starting_bid=1, seller=seller,
+                    closes_at=now - timedelta(minutes=i + 1)).save()
+        items.append(item)
+        if i % 2:
+            bid = Bid(item=item, bidder=bidder, amount=10 + i, created_at=item.closes_at - timedelta(seconds=1)).save()
+            item.update(leading_bid=bid, current_price=bid.amount)
+            # Bids that did not become the leading bid don't count.
+            Bid(item=item, bidder=late, amount=100, created_at=item.closes_at + timedelta(seconds=1)).save()
+    still_open = Item(title="Open", description="", starting_bid=1, seller=seller,
+                      closes_at=now + timedelta(hours=1)).save()
+    mongo_commands.clear()
+
+    assert close_expired_items() == 10
+
+    # Items, leading bids, highest bids of the items without one, closing, closed
+    # items, users, notifications, unread counters, and the check for more items.
+    assert len(mongo_commands) == 9, mongo_commands
+
+    for i, item in enumerate(items):
+        item.reload()
+        assert item.closed
+        if i % 2:
+            assert item.winning_bid.amount == 10 + i
+            assert item.winning_bid.bidder == bidder
+        else:
+            assert item.winning_bid is None
+    assert not still_open.reload().closed
+
+    assert Notification.objects(user=seller).count() == 10
+    assert Notification.objects(user=bidder).count() == 5
+    assert Notification.objects(user=late).count() == 0
+
+
+def test_close_items_without_leading_bid(db_app):
+    """
+    Items bid on before leading bids were maintained are won by their highest bid.
+    """
+    seller = User(email="seller@example.com", password="x").save()
+    bidder = User(email="bidder@example.com", password="x").save()
+
+    items = []
+    for _ in range(2):
+        item = Item(title="Old", description="", starting_bid=1, seller=seller,
+                    closes_at=datetime.utcnow() - timedelta(minutes=1)).save()
+        for amount in (5, 7, 6):
+            Bid(item=item, bidder=bidder, amount=amount, created_at=item.closes_at - timedelta(seconds=amount)).save()
+        items.append(item)
+
+    handle_item_closing(items[0])
+    assert close_expired_items() == 1
+
+    for item in items:
+        item.reload()
+        assert item.closed
+        assert item.winning_bid.amount == 7
+    assert Notification.objects(user=bidder).count() == 2
+
+
+def test_closing_sees_late_leading_bid(db_app):
+    """
+    A bid that became the leading bid after the item was loaded for closing wins.
+    """
+    seller = User(email="seller@example.com", password="x").save()
+    bidder = User(email="bidder@example.com", password="x").save()
+    items = []
+    for _ in range(2):
+        item = Item(title="Item", description="", starting_bid=1, seller=seller,
+                    closes_at=datetime.utcnow() - timedelta(minutes=1)).save()
+        bid = Bid(item=item, bidder=bidder, amount=5).save()
+        item.update(leading_bid=bid, current_price=5)
+        items.append(item)
+
+    stale = [Item.objects.get(id=item.id) for item in items]
+    stale_batch = list(Item.objects(id__in=[item.id for item in items]).no_dereference()
+                       .only('title', 'seller', 'closes_at', 'leading_bid'))
+    late_bids = []
+    for item in items:
+        bid = Bid(item=item, bidder=bidder, amount=10).save()
+        Item.objects(id=item.id).update_one(set__leading_bid=bid, set__current_price=10)
+        late_bids.append(bid)
+
+    handle_item_closing(stale[0])
+    assert close_items(stale_batch) == 0
+    assert close_expired_items() == 1
+
+    for item, bid in zip(items, late_bids):
+        assert item.reload().winning_bid.id == bid.id
+
+
+def test_closing_is_idempotent(db_app):
+    """
+    Closing an item again, even from a stale copy, doesn't notify twice.
+    """
+    seller = User(email="seller@example.com", password="x").save()
+    items = [
+        Item(title=f"Item {i}", description="", starting_bid=1, seller=seller,
+             closes_at=datetime.utcnow() - timedelta(minutes=1)).save()
+        for i in range(3)
+    ]
+    stale = Item.objects.get(id=items[0].id)
+
+    handle_item_closing(items[0])
+    assert items[0].closed
+    assert Notification.objects(user=seller).count() == 1
+
+    handle_item_closing(stale)
+    assert close_items(list(Item.objects(id__in=[item.id for item in items]).no_dereference())) == 2
+    assert close_items(list(Item.objects(id__in=[item.id for item in items]).no_dereference())) == 0
+    assert Notification.objects(user=seller).count() == 3
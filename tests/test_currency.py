@@ -0,0 +1,213 @@
+"""
+Currency tests
+==============
+"""
+
+from datetime import date
+import os
+from time import perf_counter, sleep
+
+import pytest
+from currency_converter import CURRENCY_FILE, CurrencyConverter, RateNotFoundError
+from flask import Flask
+from flask_babel import force_locale, format_currency
+
+from tjts5901 import create_app
+from tjts5901.currency import (
+    REF_CURRENCY,
+    convert_currency,
+    convert_many,
+    format_converted_currencies,
+)
+from tjts5901.rates import RateTable, compile_rate_snapshot, is_snapshot_current
+
+# Money tag template used before formatting was compiled.
+MONEY_TAG_TEMPLATE = '<span title="{{ base_amount|e }}">{{ local_amount }}</span>'
+
+AMOUNTS = [0, 1, 2, 5, 11, 1000, 1234567] + list(range(100, 300))
+
+
+@pytest.fixture(params=["snapshot", "converter"])
+def currency_app(request, tmp_path) -> Flask:
+    """
+    App using the currency rates shipped with the `CurrencyConverter` package.
+
+    Parametrized to use both the compiled snapshot, and the `CurrencyConverter`.
+    """
+    flask_app = create_app({
+        'TESTING': True,
+        'CURRENCY_FILE': CURRENCY_FILE,
+        'CURRENCY_SNAPSHOT_FILE': str(tmp_path / "currency.npy") if request.param == "snapshot" else None,
+    })
+
+    with flask_app.test_request_context():
+        yield flask_app
+
+
+def format_with_template(app: Flask, values, currency):
+    """
+    Reference implementation: render money tag template for each amount.
+    """
+    template = app.jinja_env.from_string(MONEY_TAG_TEMPLATE)
+    return [template.render(
+        base_amount=format_currency(value, currency=REF_CURRENCY, format_type='name'),
+        local_amount=format_currency(convert_currency(value, currency), currency=currency),
+    ) for value in values]
+
+
+@pytest.mark.parametrize("locale", ["fi_FI", "sv_SE", "en_GB"])
+@pytest.mark.parametrize("currency", [REF_CURRENCY, "SEK", "GBP"])
+def test_format_converted_currencies(currency_app, locale, currency):
+    """
+    Compiled formatting produces the same markup as the template.
+    """
+    with force_locale(locale):
+        expected = format_with_template(currency_app, AMOUNTS, currency)
+        assert [str(html) for html in format_converted_currencies(AMOUNTS, currency)] == expected
+
+
+@pytest.mark.parametrize("currency", ["USD", "SEK", "JPY"])
+def test_convert_many(currency_app, currency):
+    """
+    Vectorized conversion gives the same results as converting one by one.
+    """
+    assert convert_many(AMOUNTS, currency).tolist() == [convert_currency(value, currency) for value in AMOUNTS]
+
+    back = convert_many(convert_many(AMOUNTS, currency), REF_CURRENCY, currency, decimals=2)
+    assert back.tolist() == pytest.approx(AMOUNTS)
+
+    with pytest.raises(ValueError):
+        convert_many(AMOUNTS, "XXX")
+
+
+def test_format_converted_currencies_benchmark(currency_app, rows=2000):
+    """
+    Compare compiled formatting with rendering a template per amount.
+
+    Run with `pytest -s` to see the results.
+    """
+    values = list(range(rows))
+
+    with force_locale("fi_FI"):
+        # Warm up caches
+        format_with_template(currency_app, values[:1], "SEK")
+        format_converted_currencies(values[:1], "SEK")
+
+        started = perf_counter()
+        format_with_template(currency_app, values, "SEK")
+        template_time = perf_counter() - started
+
+        started = perf_counter()
+        format_converted_currencies(values, "SEK")
+        compiled_time = perf_counter() - started
+
+    print(f"\n{rows} amounts: template {template_time * 1000:.1f} ms, "
+          f"compiled {compiled_time * 1000:.1f} ms ({template_time / compiled_time:.1f}x)")
+
+
+@pytest.mark.parametrize("snapshot", [True, False])
+def test_convert_missing_rate(tmp_path, snapshot):
+    """
+    Currencies without a recent rate fail the same way one by one and at once.
+    """
+    currency_file = tmp_path / "currency.csv"
+    currency_file.write_text("Date,USD,SEK,\n2023-01-03,2.0,N/A,\n2023-01-02,1.9,11.0,\n")
+
+    flask_app = create_app({
+        'TESTING': True,
+        'CURRENCY_FILE': str(currency_file),
+        'CURRENCY_SNAPSHOT_FILE': str(tmp_path / "currency.npy") if snapshot else None,
+    })
+
+    with flask_app.test_request_context():
+        assert convert_many([1, 2], "USD").tolist() == [convert_currency(1, "USD"), convert_currency(2, "USD")]
+
+        with pytest.raises(RateNotFoundError):
+            convert_currency(1, "SEK")
+        with pytest.raises(RateNotFoundError):
+            convert_many([1, 2], "SEK")
+        with pytest.raises(RateNotFoundError):
+            format_converted_currencies([1, 2], "SEK")
+
+
+def test_rate_table(tmp_path):
+    """
+    Rate table snapshot converts like the `CurrencyConverter`.
+    """
+    snapshot_file = str(tmp_path / "currency.npy")
+    compile_rate_snapshot(CURRENCY_FILE, snapshot_file, REF_CURRENCY)
+
+    # Readable by workers running as other users.
+    assert os.stat(snapshot_file).st_mode & 0o777 == 0o644
+
+    table = RateTable.load(snapshot_file, REF_CURRENCY)
+    converter = CurrencyConverter(CURRENCY_FILE, ref_currency=REF_CURRENCY)
+
+    assert table.currencies == converter.currencies
+
+    for currency in sorted(converter.currencies):
+        for day in (None, date(2010, 11, 22), date(2010, 11, 21)):
+            try:
+                expected = converter.convert(123.45, currency, "USD", date=day)
+            except RateNotFoundError:
+                with pytest.raises(RateNotFoundError):
+                    table.convert(123.45, currency, "USD", date=day)
+            else:
+                assert table.convert(123.45, currency, "USD", date=day) == expected
+
+
+def test_snapshot_current(tmp_path):
+    """
+    Snapshot is compiled again when the currency file is changed or replaced, even with an older one.
+    """
+    currency_file = tmp_path / "currency.csv"
+    currency_file.write_text("Date,USD,\n2023-01-02,2.0,\n")
+    snapshot_file = str(tmp_path / "currency.npy")
+
+    assert not is_snapshot_current(str(currency_file), snapshot_file)
+    compile_rate_snapshot(str(currency_file), snapshot_file, REF_CURRENCY)
+    assert is_snapshot_current(str(currency_file), snapshot_file)
+
+    mtime = currency_file.stat().st_mtime - 3600
+    os.utime(currency_file, (mtime, mtime))
+    assert not is_snapshot_current(str(currency_file), snapshot_file)
+
+    compile_rate_snapshot(str(currency_file), snapshot_file, REF_CURRENCY)
+    assert is_snapshot_current(str(currency_file), snapshot_file)
+
+    other_file = tmp_path / "other.csv"
+    other_file.write_text(currency_file.read_text())
+    os.utime(other_file, (mtime, mtime))
+    assert not is_snapshot_current(str(other_file), snapshot_file)
+
+
+def test_currency_reload(tmp_path):
+    """
+    Updated currency file is picked up in the background after a reload request.
+    """
+    currency_file = tmp_path / "currency.csv"
+    currency_file.write_text("Date,USD,\n2023-01-02,2.0,\n")
+
+    flask_app = create_app({
+        'TESTING': True,
+        'CURRENCY_FILE': str(currency_file),
+        'CURRENCY_SNAPSHOT_FILE': str(tmp_path / "currency.npy"),
+        'CURRENCY_RELOAD_INTERVAL': 3600,
+    })
+    converter = flask_app.extensions['currency_converter']
+    assert converter.convert(1, REF_CURRENCY, "USD") == 2.0
+
+    currency_file.write_text("Date,USD,\n2023-01-03,3.0,\n")
+    mtime = currency_file.stat().st_mtime + 10
+    os.utime(currency_file, (mtime, mtime))
+
+    # Not checked until the interval has passed
+    assert converter.convert(1, REF_CURRENCY, "USD") == 2.0
+
+    converter.request_reload()
+    for _ in range(100):
+        if converter.convert(1, REF_CURRENCY, "USD") == 3.0:
+            break
+        sleep(0.01)
+
+    assert converter.convert(1, REF_CURRENCY, "USD") == 3.0
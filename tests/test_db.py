@@ -0,0 +1,77 @@
+"""
+Database helper tests
+=====================
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from tjts5901.db import get_document, prefetch_references
+from tjts5901.models import Bid, Item, User
+
+
+def create_items(count):
+    """
+    Create items, each with their own seller and a leading bid by their own bidder.
+    """
+    closes_at = datetime.utcnow() + timedelta(hours=1)
+    for i in range(count):
+        seller = User(email=f"seller{i}@example.com", password="x").save()
+        bidder = User(email=f"bidder{i}@example.com", password="x").save()
+        item = Item(title=f"Item {i}", description="", starting_bid=1,
+                    seller=seller, closes_at=closes_at).save()
+        bid = Bid(item=item, bidder=bidder, amount=2).save()
+        item.update(leading_bid=bid, current_price=bid.amount)
+
+
+@pytest.mark.parametrize("page_size", [5, 50])
+def test_prefetch_references(db_app, mongo_commands, page_size):
+    """
+    Resolving references takes one query per referenced collection, regardless
+    of the number of documents.
+    """
+    create_items(page_size)
+    mongo_commands.clear()
+
+    items = prefetch_references(Item.objects.no_dereference(), 'seller', 'leading_bid.bidder')
+
+    for item in items:
+        assert item.seller.email.startswith("seller")
+        assert item.leading_bid.bidder.email.startswith("bidder")
+
+    # Items, sellers, bids and bidders.
+    assert len(mongo_commands) == 4, mongo_commands
+    assert len(items) == page_size
+
+
+def test_prefetch_references_known(db_app, mongo_commands):
+    """
+    Known documents are used without querying.
+    """
+    create_items(3)
+    items = list(Item.objects.no_dereference())
+    sellers = list(User.objects(email__startswith="seller"))
+    mongo_commands.clear()
+
+    prefetch_references(items, 'seller', known=sellers)
+
+    assert {item.seller.email for item in items} == {seller.email for seller in sellers}
+    assert not mongo_commands
+
+
+def test_identity_map(db_app, mongo_commands):
+    """
+    Documents are loaded once per request, also when dereferenced.
+    """
+    create_items(1)
+    item = Item.objects.first()
+    mongo_commands.clear()
+
+    bid = get_document(Bid, item.leading_bid.id)
+    assert get_document(Bid, str(bid.id)) is bid
+    assert item.leading_bid is bid
+    assert bid.item.leading_bid is bid
+
+    # The bid, and its item
+    assert len(mongo_commands) == 2, mongo_commands
@@ -0,0 +1,128 @@
+"""
+Event stream tests
+==================
+"""
+
+from datetime import datetime, timedelta
+import json
+
+from tjts5901 import create_app
+from tjts5901.events import LocalBroadcaster, Subscription, publish, stream_events
+from tjts5901.items import handle_item_closing, place_bid
+from tjts5901.models import Item, User
+
+
+def parse_sse(message):
+    """
+    Parse a Server-Sent Events message into event name and data.
+    """
+    if isinstance(message, bytes):
+        message = message.decode()
+    fields = dict(line.split(": ", 1) for line in message.strip().splitlines())
+    return fields["event"], json.loads(fields["data"])
+
+
+def test_local_broadcaster():
+    """
+    Events are delivered to the subscribers of the channel only.
+    """
+    broadcaster = LocalBroadcaster()
+    first = broadcaster.subscribe("item:1")
+    second = broadcaster.subscribe("item:1")
+    other = broadcaster.subscribe("item:2")
+
+    broadcaster.publish("item:1", "bid", {"price": 10})
+
+    assert first.get(timeout=0) == ("bid", {"price": 10})
+    assert second.get(timeout=0) == ("bid", {"price": 10})
+    assert other.get(timeout=0) is None
+
+    broadcaster.unsubscribe(first)
+    broadcaster.publish("item:1", "bid", {"price": 11})
+    assert first.get(timeout=0) is None
+    assert second.get(timeout=0) == ("bid", {"price": 11})
+
+
+def test_subscription_drops_oldest():
+    """
+    Slow subscribers lose the oldest events instead of blocking the publisher.
+    """
+    subscription = Subscription("item:1", maxsize=2)
+    for price in range(3):
+        subscription.put(("bid", {"price": price}))
+
+    assert subscription.get(timeout=0) == ("bid", {"price": 1})
+    assert subscription.get(timeout=0) == ("bid", {"price": 2})
+
+
+def test_shared_broadcaster():
+    """
+    Applications sharing a broadcaster, like workers would, see each other's events.
+    """
+    broadcaster = LocalBroadcaster()
+    worker1 = create_app({'TESTING': True, 'EVENT_BROADCASTER': broadcaster})
+    worker2 = create_app({'TESTING': True, 'EVENT_BROADCASTER': broadcaster})
+
+    subscription = worker2.extensions['broadcaster'].subscribe("item:1")
+    with worker1.app_context():
+        publish("item:1", "bid", {"price": 10})
+
+    assert subscription.get(timeout=0) == ("bid", {"price": 10})
+
+
+def test_stream_events():
+    """
+    The stream sends the initial events, keepalives when idle, and ends on the given event.
+    """
+    broadcaster = LocalBroadcaster()
+    subscription = broadcaster.subscribe("item:1")
+    stream = stream_events(broadcaster, subscription, [("price", {"price": 10})],
+                           keepalive=0, until=("closed",))
+
+    assert parse_sse(next(stream)) == ("price", {"price": 10})
+    assert next(stream) == ": keepalive\n\n"
+
+    broadcaster.publish("item:1", "bid", {"price": 11})
+    broadcaster.publish("item:1", "closed", {})
+    assert parse_sse(next(stream)) == ("bid", {"price": 11})
+    assert parse_sse(next(stream)) == ("closed", {})
+    assert list(stream) == []
+
+    # Ending the stream cancels the subscription.
+    broadcaster.publish("item:1", "bid", {"price": 12})
+    assert subscription.get(timeout=0) is None
+
+
+def test_item_events(db_app):
+    """
+    The price stream of an item follows its bids until it closes.
+    """
+    seller = User(email="seller@example.com", password="x").save()
+    bidder = User(email="bidder@example.com", password="x").save()
+    item = Item(title="Streamed item", description="", starting_bid=10, seller=seller,
+                closes_at=datetime.utcnow() + timedelta(hours=1)).save()
+
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(bidder.id)
+        session['_fresh'] = True
+
+    response = client.get(f"/api/items/{item.id}/events", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    stream = iter(response.response)
+
+    assert parse_sse(next(stream)) == ("price", {"item": str(item.id), "price": 10, "min_amount": 11})
+
+    assert place_bid(item, bidder, 20).success
+    event, data = parse_sse(next(stream))
+    assert event == "bid"
+    assert (data["price"], data["min_amount"]) == (20, 21)
+
+    item.update(closes_at=datetime.utcnow() - timedelta(seconds=1))
+    item.reload()
+    handle_item_closing(item)
+    event, data = parse_sse(next(stream))
+    assert event == "closed"
+    assert data["winning_bid"]["amount"] == 20
+    assert list(stream) == []
+    response.close()
@@ -0,0 +1,48 @@
+"""
+Leader election tests
+=====================
+"""
+
+from datetime import timedelta
+
+from tjts5901.leader import FileLease, MongoLease
+
+
+def test_file_lease(tmp_path):
+    """
+    Only one holder of the lock file is the leader, until it lets go.
+    """
+    path = str(tmp_path / "scheduler.lock")
+    first = FileLease("scheduler", path)
+    second = FileLease("scheduler", path)
+
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+
+    first.release()
+    assert second.acquire()
+    assert not first.acquire()
+    second.release()
+
+
+def test_mongo_lease(db_app):
+    """
+    Only one holder of the lease is the leader, until it expires or is released.
+    """
+    first = MongoLease("scheduler", timedelta(seconds=30))
+    second = MongoLease("scheduler", timedelta(seconds=30))
+
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+
+    first.release()
+    assert second.acquire()
+    assert not first.acquire()
+
+    # A leader that stops renewing loses the lease.
+    second.ttl = timedelta(seconds=-1)
+    assert second.acquire()
+    assert first.acquire()
+    assert not second.acquire()
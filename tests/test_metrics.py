@@ -0,0 +1,111 @@
+"""
+Metrics tests
+=============
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from tjts5901 import create_app
+from tjts5901.metrics import (
+    MONGODB_COMMAND_DURATION,
+    CommandMetrics,
+    Counter,
+    Histogram,
+    registry,
+)
+from tjts5901.models import User
+
+
+def sample_values(metric) -> dict:
+    """
+    Map the names and labels of the samples of a metric to their values.
+    """
+    return {(name, tuple(sorted(labels.items()))): value for name, labels, value in metric.samples()}
+
+
+def test_histogram():
+    """
+    Observations are counted in cumulative buckets.
+    """
+    histogram = Histogram("job_seconds", "Job durations.", ("job",), buckets=(0.1, 1))
+    histogram.observe(0.05, job="a")
+    histogram.observe(0.1, job="a")
+    histogram.observe(5, job="a")
+
+    assert histogram.render() == (
+        "# HELP job_seconds Job durations.\n"
+        "# TYPE job_seconds histogram\n"
+        'job_seconds_bucket{job="a",le="0.1"} 2.0\n'
+        'job_seconds_bucket{job="a",le="1.0"} 2.0\n'
+        'job_seconds_bucket{job="a",le="+Inf"} 3.0\n'
+        'job_seconds_sum{job="a"} 5.15\n'
+        'job_seconds_count{job="a"} 3.0\n'
+    )
+
+    with pytest.raises(ValueError):
+        histogram.observe(1, queue="a")
+
+
+def test_counter_labels():
+    """
+    Label values are escaped.
+    """
+    counter = Counter("errors_total", "Errors.", ("message",))
+    counter.inc(message='say "hi"\n')
+    counter.inc(2, message='say "hi"\n')
+
+    assert counter.render().splitlines()[-1] == 'errors_total{message="say \\"hi\\"\\n"} 3.0'
+
+
+def test_command_metrics():
+    """
+    MongoDB commands are timed per collection.
+    """
+    listener = CommandMetrics()
+    before = sample_values(MONGODB_COMMAND_DURATION)
+
+    listener.started(SimpleNamespace(command_name="find", command={"find": "metrics_test"}, request_id=1))
+    listener.succeeded(SimpleNamespace(command_name="find", request_id=1, duration_micros=2000))
+
+    key = ("mongodb_command_duration_seconds_count", (("collection", "metrics_test"), ("command", "find")))
+    assert sample_values(MONGODB_COMMAND_DURATION)[key] == before.get(key, 0) + 1
+
+
+def test_metrics_endpoint():
+    """
+    Requests are counted per endpoint, and exposed in the Prometheus text format
+    to scrapers with the token.
+    """
+    client = create_app({'TESTING': True, 'METRICS_TOKEN': 'secret'}).test_client()
+    assert client.get("/hello").status_code == 200
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+
+    body = response.get_data(as_text=True)
+    assert '# TYPE http_request_duration_seconds histogram' in body
+    assert 'http_requests_total{endpoint="hello",method="GET",status="200"}' in body
+    assert 'http_request_duration_seconds_count{endpoint="hello",method="GET"}' in body
+
+
+def test_metrics_endpoint_disabled(client):
+    """
+    Metrics are not exposed without a token.
+    """
+    assert client.get("/metrics").status_code == 404
+
+
+def test_database_metrics(db_app):
+    """
+    Commands of the application's connection are recorded.
+    """
+    User(email="user@example.com", password="x").save()
+
+    samples = registry.get("mongodb_command_duration_seconds").samples()
+    assert any(labels == {"command": "insert", "collection": "user"} for _, labels, _ in samples)
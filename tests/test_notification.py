@@ -0,0 +1,70 @@
+"""
+Notification tests
+==================
+"""
+
+import threading
+
+from flask_babel import lazy_gettext
+
+from tjts5901.models import Notification, User
+from tjts5901.notification import NotificationOutbox, get_notifications, send_notification, send_notifications
+
+
+def test_outbox(db_app, mongo_commands):
+    """
+    Queued notifications are translated and inserted in batches, and all delivered on close.
+    """
+    user = User(email="user@example.com", password="x").save()
+    outbox = NotificationOutbox(db_app, batch_size=10, linger=1)
+    mongo_commands.clear()
+
+    for i in range(25):
+        outbox.put(user, lazy_gettext("Message %(number)s", number=i), title=lazy_gettext("Message"))
+    outbox.flush()
+
+    # Notifications and unread counters for each batch.
+    assert mongo_commands == ['insert', 'update'] * 3
+    assert Notification.objects(user=user).count() == 25
+    assert Notification.objects(user=user, title="Message", message="Message 24").count() == 1
+
+    outbox.put(user, "Last message")
+    outbox.close()
+    assert Notification.objects(user=user).count() == 26
+
+
+def test_outbox_full(db_app):
+    """
+    When the queue is full, the sender delivers the notification itself.
+    """
+    user = User(email="user@example.com", password="x").save()
+    outbox = NotificationOutbox(db_app, maxsize=1, put_timeout=0)
+    # Stand in for a worker that has fallen behind.
+    outbox._thread = threading.Thread(target=lambda: None)  # pylint: disable=protected-access
+    outbox._queue.put((user, "Queued", "message", None))  # pylint: disable=protected-access
+
+    outbox.put(user, "Overflow")
+    assert Notification.objects(user=user).count() == 1
+
+
+def test_unread_counter(db_app, mongo_commands):
+    """
+    Notifications are only queried when the unread counter says there are new ones.
+    """
+    user = User(email="user@example.com", password="x").save()
+    send_notification(user, "Before counting")
+
+    # Notifications from before the counter are found on the first look.
+    user.reload()
+    assert [message.message for message in get_notifications(user)] == ["Before counting"]
+    assert user.reload().unread_notifications == 0
+
+    mongo_commands.clear()
+    assert get_notifications(user) == []
+    assert not mongo_commands
+
+    send_notifications([{'user': user, 'message': "First"}, {'user': user, 'message': "Second"}])
+    assert user.reload().unread_notifications == 2
+    assert {message.message for message in get_notifications(user)} == {"First", "Second"}
+    assert user.reload().unread_notifications == 0
+    assert Notification.objects(user=user, read_at=None).count() == 0
@@ -0,0 +1,140 @@
+"""
+Query budget tests
+==================
+
+The main pages must send a constant number of MongoDB commands, however much
+data there is to show. Each page is loaded with a little and with a lot of
+data, within the same budget and with the same number of commands.
+
+These need a MongoDB server, see the `db_app` fixture in conftest.py.
+"""
+
+from datetime import datetime, timedelta
+
+from currency_converter import CURRENCY_FILE
+import pytest
+
+from tjts5901.items import get_item_price
+from tjts5901.models import Bid, Item, User
+
+
+@pytest.fixture
+def user(db_app):
+    """
+    The logged in user.
+    """
+    return User(email="user@example.com", password="x").save()
+
+
+@pytest.fixture
+def client(db_app, user):
+    """
+    Test client logged in as `user`.
+    """
+    db_app.config['CURRENCY_FILE'] = CURRENCY_FILE
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+        session['locale'] = 'en_GB'
+    return client
+
+
+def make_users(count: int) -> list[User]:
+    """
+    Create users with one insert.
+    """
+    start = User.objects.count()
+    return User.objects.insert([User(email=f"user{start + i}@example.com", password="x")
+                                for i in range(count)])
+
+
+def make_items(sellers: list[User], count: int) -> list[Item]:
+    """
+    Create open items, each sold by the next of the `sellers`.
+    """
+    now = datetime.utcnow()
+    return Item.objects.insert([
+        Item(title=f"Item {i}", description="", starting_bid=10, seller=sellers[i % len(sellers)],
+             closes_at=now + timedelta(hours=1, minutes=i))
+        for i in range(count)
+    ])
+
+
+def make_bids(item: Item, bidders: list[User]):
+    """
+    Create rising bids on the item, one by each of the `bidders`, and make the
+    last one the leading bid, like placing them one by one would.
+    """
+    item.reload()
+    price = get_item_price(item)
+    now = datetime.utcnow()
+    bids = Bid.objects.insert([
+        Bid(item=item, bidder=bidder, amount=price + i + 1, created_at=now - timedelta(seconds=len(bidders) - i))
+        for i, bidder in enumerate(bidders)
+    ])
+    item.update(set__leading_bid=bids[-1], set__current_price=bids[-1].amount, inc__bid_count=len(bids))
+
+
+def get_page(client, query_budget, url: str, budget: int) -> list[str]:
+    """
+    Load the page within the query budget, and return the commands it sent.
+
+    The page is loaded once before, to fill the caches of the process, like
+    the logged in user and the unread notification count.
+    """
+    assert client.get(url).status_code == 200
+    with query_budget(budget) as commands:
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+    return commands
+
+
+def test_index_budget(client, query_budget):
+    """
+    The item listing loads all the sellers on the page at once.
+    """
+    make_items(make_users(5), 5)
+    few = get_page(client, query_budget, "/", 3)
+
+    make_items(make_users(495), 495)
+    many = get_page(client, query_budget, "/", 3)
+    assert many == few
+
+
+def test_view_budget(client, query_budget, user):
+    """
+    The item page does not load the bids one by one.
+    """
+    item = make_items([user], 1)[0]
+    make_bids(item, make_users(5))
+    few = get_page(client, query_budget, f"/item/{item.id}", 3)
+
+    make_bids(item, make_users(200))
+    many = get_page(client, query_budget, f"/item/{item.id}", 3)
+    assert many == few
+
+
+def test_item_bids_budget(client, query_budget, user):
+    """
+    The bid history pages through the bids with one query.
+    """
+    item = make_items([user], 1)[0]
+    make_bids(item, make_users(5))
+    few = get_page(client, query_budget, f"/api/items/{item.id}/bids", 2)
+
+    make_bids(item, make_users(500))
+    many = get_page(client, query_budget, f"/api/items/{item.id}/bids", 2)
+    assert many == few
+
+
+def test_profile_budget(client, query_budget, user):
+    """
+    The profile lists the items of the user without loading the seller again.
+    """
+    make_items([user], 5)
+    few = get_page(client, query_budget, "/auth/profile", 2)
+
+    make_items([user], 200)
+    many = get_page(client, query_budget, "/auth/profile", 2)
+    assert many == few
@@ -0,0 +1,101 @@
+"""
+Scheduler tests
+===============
+"""
+
+from datetime import datetime, timedelta
+import sys
+import threading
+import time
+
+from bson import ObjectId
+import pytest
+
+from tjts5901 import scheduler
+from tjts5901.closing import ClosingEngine
+from tjts5901.events import LocalBroadcaster
+from tjts5901.leader import FileLease
+from tjts5901.scheduler import CLOSING_CHANNEL, is_server_process, release_leadership, update_closing_queue
+
+
+@pytest.mark.parametrize("argv, expected", [
+    (["/usr/bin/flask", "run", "--host=0.0.0.0"], True),
+    (["/usr/lib/python3/site-packages/flask/__main__.py", "--app", "tjts5901.app", "run"], True),
+    (["/usr/bin/gunicorn", "tjts5901.app:flask_app"], True),
+    (["/app/src/tjts5901/__main__.py"], True),
+    (["/usr/bin/flask", "update-currency-rates"], False),
+    (["/usr/bin/flask", "items", "backfill-prices"], False),
+    (["-c"], False),
+    ([""], False),
+])
+def test_is_server_process(monkeypatch, argv, expected):
+    """
+    The jobs run by default only in the processes serving the application.
+    """
+    monkeypatch.setattr(sys, "argv", argv)
+    assert is_server_process() is expected
+
+
+def test_closing_queue_follows_other_processes(monkeypatch):
+    """
+    Items saved in other processes than the leader are scheduled by the leader,
+    through a shared broadcaster.
+    """
+    engine = ClosingEngine(lambda item_id: None)
+    monkeypatch.setattr(scheduler, "closing_engine", engine)
+    broadcaster = LocalBroadcaster()
+    subscription = broadcaster.subscribe(CLOSING_CHANNEL)
+    item_id, closes_at = ObjectId(), datetime.utcnow() + timedelta(hours=1)
+
+    # Not the leader, and no shared broadcaster: left for the leader to find.
+    monkeypatch.setattr(scheduler, "is_leader", False)
+    monkeypatch.setattr(scheduler, "closing_broadcaster", None)
+    update_closing_queue(item_id, closes_at)
+    assert len(engine) == 0
+    assert subscription.get(timeout=0) is None
+
+    # Not the leader: nothing is queued, the closing time is published.
+    monkeypatch.setattr(scheduler, "closing_broadcaster", broadcaster)
+    update_closing_queue(item_id, closes_at)
+    assert len(engine) == 0
+
+    # The leader queues the items it hears about.
+    monkeypatch.setattr(scheduler, "is_leader", True)
+    threading.Thread(target=scheduler._follow_closing_events, args=(subscription,), daemon=True).start()
+    for _ in range(100):
+        if len(engine):
+            break
+        time.sleep(0.01)
+    assert engine.pop_due(closes_at) == [item_id]
+
+    update_closing_queue(item_id, None)
+    assert len(engine) == 0
+
+
+def test_release_leadership(tmp_path, monkeypatch):
+    """
+    The leader gives up its lease, so another process can take over at once.
+    """
+    path = str(tmp_path / "scheduler.lock")
+    lease = FileLease("scheduler", path)
+    assert lease.acquire()
+    monkeypatch.setattr(scheduler, "leader_lease", lease)
+    monkeypatch.setattr(scheduler, "is_leader", True)
+
+    release_leadership()
+    assert not scheduler.is_leader
+    assert FileLease("scheduler", path).acquire()
+
+
+def test_migrations_run_once(db_app, monkeypatch):
+    """
+    The leader backfills item prices on startup, once per database.
+    """
+    calls = []
+    monkeypatch.setattr(scheduler, "backfill_item_prices", lambda: calls.append(1) or 0)
+    monkeypatch.setattr(scheduler.scheduler, "app", db_app)
+    monkeypatch.setattr(scheduler, "is_leader", True)
+
+    scheduler._run_migrations()
+    scheduler._run_migrations()
+    assert calls == [1]
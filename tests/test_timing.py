@@ -0,0 +1,58 @@
+"""
+Server timing tests
+===================
+"""
+
+import logging
+
+from currency_converter import CURRENCY_FILE
+from flask import render_template_string
+
+from tjts5901 import create_app
+from tjts5901.timing import format_server_timing
+
+
+def test_format_server_timing():
+    """
+    Phases are given in milliseconds, with their counts.
+    """
+    header = format_server_timing({'db': [0.0121, 3], 'template': [0.0305, 1]}, 0.051)
+    assert header == 'db;dur=12.1;desc="3 commands", template;dur=30.5;desc="1 render", total;dur=51.0'
+
+
+def test_server_timing_disabled(client):
+    """
+    The header is only sent when enabled.
+    """
+    assert "Server-Timing" not in client.get("/auth/login").headers
+
+
+def test_server_timing(caplog):
+    """
+    Rendering, currency formatting and locale resolution are timed, and slow requests logged.
+    """
+    app = create_app({
+        'TESTING': True,
+        'CURRENCY_FILE': CURRENCY_FILE,
+        'SERVER_TIMING': True,
+        'SERVER_TIMING_SLOW_THRESHOLD': 0,
+        'SERVER_TIMING_LOG_SAMPLE_RATE': 1,
+    })
+
+    @app.route("/price")
+    def price():
+        return render_template_string("{{ 10|localcurrency }} {{ 20|localcurrency }}")
+
+    with caplog.at_level(logging.WARNING, logger="tjts5901.timing"):
+        response = app.test_client().get("/price?locale=fi_FI")
+    assert response.status_code == 200
+
+    phases = dict(entry.split(";", 1) for entry in response.headers["Server-Timing"].split(", "))
+    assert phases["template"].endswith('desc="1 render"')
+    assert phases["currency"].endswith('desc="2 calls"')
+    assert phases["locale"].endswith('desc="1 call"')
+    assert "total" in phases
+
+    record, = [record for record in caplog.records if record.name == "tjts5901.timing"]
+    assert record.endpoint == "price"
+    assert record.timings["currency"]["count"] == 2